@@ -0,0 +1,654 @@
+"""
+Offline checks of the GANS data pipeline.
+
+Like the benchmarks, the checks load the pipeline functions from GANS-data_engineering.py without running its
+cells, and use SQLite databases in a temporary directory and the recorded fixtures (benchmarks/fixtures), so no
+API key, database server or network is needed. Every check raises AssertionError when the pipeline misbehaves.
+
+Usage:
+    python benchmarks/checks.py                            # run every check
+    python benchmarks/checks.py --checks natural_key_duplicates lambda_legacy_table
+"""
+import argparse
+import json
+import os
+import sys
+import tempfile
+import time
+import traceback
+
+from run_benchmarks import FIXTURES_DIR, load_pipeline, start_stub_server
+
+
+def check_natural_key_duplicates(ns, directory):
+    """A table stored without its unique index holds duplicates: the first upsert keeps the latest retrieved row of every key and creates the index."""
+    pd = ns['pd']
+    sqlalchemy = ns['sqlalchemy']
+    engine = ns['get_engine']('sqlite:///' + os.path.join(directory, 'duplicates.db'))
+    arrival_time = pd.Timestamp('2024-05-02 12:00', tz='UTC')
+    stored = pd.DataFrame({'arrival_airport_icao': ['EDDB', 'EDDB', 'EGLL'], 'flight_number': ['LH 1', 'LH 2', 'BA 1'],
+                           'airline': ['Lufthansa', 'Lufthansa', 'British Airways'], 'arrival_time': [arrival_time] * 3,
+                           'departure_city': ['Frankfurt', 'Munich', 'New York'],
+                           'departure_airport_icao': ['EDDF', 'EDDM', 'KJFK'],
+                           'data_retrived_on': pd.to_datetime(['2024-05-01'] * 3)})
+    # Seed the table with the declared column types but without a unique index, the latest rows stored first: the
+    # retrieval date, not the storage order, tells which row of a key is the latest.
+    column_types = ns['gans_schema'].column_types('cities_arrivals')
+    latest = stored.iloc[:2].assign(departure_city='latest', data_retrived_on=pd.Timestamp('2024-05-02'))
+    latest.pipe(ns['gans_schema'].to_database).to_sql('cities_arrivals', engine, index=False, dtype=column_types)
+    for rows in [stored, stored.iloc[:1]]:
+        ns['gans_schema'].to_database(rows).to_sql('cities_arrivals', engine, index=False, if_exists='append', dtype=column_types)
+
+    new = stored.iloc[[2]].assign(flight_number='BA 2')
+    assert ns['upsert_dataframe'](new, 'cities_arrivals', engine) == {'inserted': 1, 'updated': 0}
+
+    table = pd.read_sql('SELECT flight_number, departure_city FROM cities_arrivals ORDER BY flight_number', engine)
+    assert table.values.tolist() == [['BA 1', 'New York'], ['BA 2', 'New York'], ['LH 1', 'latest'], ['LH 2', 'latest']], table
+    unique_keys = [index['column_names'] for index in sqlalchemy.inspect(engine).get_indexes('cities_arrivals') if index['unique']]
+    assert ns['NATURAL_KEYS']['cities_arrivals'] in unique_keys, unique_keys
+
+
+def check_legacy_table_migration(ns, directory):
+    """Tables appended by the first notebook (TEXT keys, local times) are refused by the upsert, and migrated to UTC rows it updates."""
+    pd = ns['pd']
+    gans_schema = ns['gans_schema']
+    engine = ns['get_engine']('sqlite:///' + os.path.join(directory, 'legacy.db'))
+    # The frames of the first notebook, appended twice with 'to_sql': the forecast retrieved at 14:00 and 15:00 in Berlin (CEST).
+    weather = pd.DataFrame({'city_id': [1], 'country': ['DE'], 'forecast_time': ['2024-05-02 12:00:00'], 'weather': ['Clouds'],
+                            'temperature': [14.5], 'temperature_feels_like': [13.9], 'clouds': [75], 'wind_speed': [3.1],
+                            'humidity': [60], 'pressure': [1012], 'rain': ['0'], 'snow': ['0'],
+                            'information_retrieved_at': ['01/05/2024 14:00:00']})
+    arrivals = pd.DataFrame({'arrival_airport_icao': ['EDDB'], 'flight_number': ['LH 1'], 'airline': ['Lufthansa'],
+                             'arrival_time': pd.to_datetime(['2024-05-02 09:20']), 'departure_city': ['Frankfurt'],
+                             'departure_airport_icao': ['EDDF'], 'data_retrived_on': pd.to_datetime(['2024-05-01'])})
+    for hour in ['14', '15']:
+        weather.assign(information_retrieved_at=f'01/05/2024 {hour}:00:00').to_sql('cities_weather', engine, index=False, if_exists='append')
+        arrivals.to_sql('cities_arrivals', engine, index=False, if_exists='append')
+
+    new_weather = gans_schema.enforce(weather.assign(forecast_time='2024-05-02 12:00:00+00:00', information_retrieved_at='2024-05-01 13:00:00+00:00'), 'cities_weather')
+    new_arrivals = gans_schema.enforce(arrivals.assign(arrival_time=pd.Timestamp('2024-05-02 07:20', tz='UTC'), airline='Lufthansa Cargo'), 'cities_arrivals')
+    for table_name, df in [('cities_weather', new_weather), ('cities_arrivals', new_arrivals)]:
+        try:
+            ns['upsert_dataframe'](df, table_name, engine)
+        except gans_schema.LegacyTableError as error:
+            assert 'migrate_legacy_table' in str(error), error
+        else:
+            raise AssertionError(f'{table_name}: a legacy table was upserted')
+
+    results = ns['migrate_legacy_tables'](engine, airport_timezones={'EDDB': 'Europe/Berlin'})
+    assert results['cities_weather'] == {'read': 2, 'written': 2} and results['cities_arrivals'] == {'read': 2, 'written': 1}, results
+    stored = pd.read_sql_table('cities_weather', engine)
+    assert stored['information_retrieved_at'].astype(str).tolist() == ['2024-05-01 12:00:00', '2024-05-01 13:00:00'], stored
+    assert stored['forecast_time'].astype(str).tolist() == ['2024-05-02 12:00:00'] * 2, stored
+    assert pd.read_sql_table('cities_arrivals', engine)['arrival_time'].astype(str).tolist() == ['2024-05-02 07:20:00']
+    assert len(pd.read_sql_table('cities_weather_legacy', engine)) == 2
+
+    # The rows written now match the migrated keys: they are updated, not stored again.
+    assert ns['upsert_dataframe'](new_weather, 'cities_weather', engine) == {'inserted': 0, 'updated': 1}
+    assert ns['upsert_dataframe'](new_arrivals, 'cities_arrivals', engine) == {'inserted': 0, 'updated': 1}
+    assert pd.read_sql_table('cities_arrivals', engine)['airline'].tolist() == ['Lufthansa Cargo']
+    # Migrating again does nothing.
+    assert ns['migrate_legacy_tables'](engine)['cities_weather'] == {'read': 0, 'written': 0}
+
+
+def check_sync_table(ns, directory):
+    """'sync_table' inserts the new rows, updates the changed ones and deletes the missing ones, but deletes nothing after a partial fetch."""
+    pd = ns['pd']
+    engine = ns['get_engine']('sqlite:///' + os.path.join(directory, 'sync.db'))
+    cities_info = pd.DataFrame({'city': ['Berlin', 'London', 'Barcelona'], 'country': ['Germany', 'United Kingdom', 'Spain'],
+                                'latitude': [52.52, 51.51, 41.38], 'longitude': [13.4, -0.13, 2.18],
+                                'population': [3850809, 8866180, 1620343], 'city_id': [1, 2, 3]})
+    assert ns['sync_table'](cities_info, 'cities_info', engine) == {'inserted': 3, 'updated': 0, 'deleted': 0, 'unchanged': 0}
+    # Nothing changed: nothing is written.
+    assert ns['sync_table'](cities_info, 'cities_info', engine, delete=True) == {'inserted': 0, 'updated': 0, 'deleted': 0, 'unchanged': 3}
+
+    # Berlin's population changed, Barcelona was removed from the list and Cagliari added.
+    fresh = pd.concat([cities_info.iloc[:2], pd.DataFrame({'city': ['Cagliari'], 'country': ['Italy'], 'latitude': [39.22],
+                                                           'longitude': [9.11], 'population': [149883], 'city_id': [4]})])
+    fresh.loc[fresh['city'] == 'Berlin', 'population'] = 3900000
+    assert ns['sync_table'](fresh, 'cities_info', engine, delete=True) == {'inserted': 1, 'updated': 1, 'deleted': 1, 'unchanged': 1}
+    stored = pd.read_sql('SELECT city, population FROM cities_info ORDER BY city_id', engine)
+    assert stored.values.tolist() == [['Berlin', 3900000], ['London', 8866180], ['Cagliari', 149883]], stored
+
+    # London's page failed this time: it is missing from the fresh rows, but is not deleted.
+    with ns['failures_recorded']() as failures:
+        ns['record_failure']('recreate_wiki', 'London', LookupError('No population in the infobox of London'))
+    fresh = fresh[fresh['city'] != 'London']
+    assert ns['sync_table'](fresh, 'cities_info', engine, delete=not failures) == {'inserted': 0, 'updated': 0, 'deleted': 0, 'unchanged': 2}
+    assert pd.read_sql('SELECT city FROM cities_info ORDER BY city_id', engine)['city'].tolist() == ['Berlin', 'London', 'Cagliari']
+
+
+def check_forecast_changes(ns, directory):
+    """A forecast slot equal to its latest stored version is not written again; a new or changed slot is stored as a new version."""
+    pd = ns['pd']
+    engine = ns['get_engine']('sqlite:///' + os.path.join(directory, 'forecasts.db'))
+
+    def forecasts(retrieved_at, temperatures):
+        # The forecasts of Berlin at 12:00 and 15:00 UTC, retrieved at 'retrieved_at', without rain or snow.
+        return ns['gans_schema'].enforce(pd.DataFrame({
+            'city_id': [1, 1], 'country': ['DE', 'DE'], 'forecast_time': pd.to_datetime(['2024-05-02 12:00', '2024-05-02 15:00'], utc=True),
+            'weather': ['Clouds', 'Clouds'], 'temperature': temperatures, 'temperature_feels_like': [13.9, 15.2], 'clouds': [75, 40],
+            'rain': [float('nan')] * 2, 'snow': [float('nan')] * 2, 'wind_speed': [3.1, 2.7], 'humidity': [60, 55], 'pressure': [1012, 1011],
+            'information_retrieved_at': [pd.Timestamp(retrieved_at, tz='UTC')] * 2}), 'cities_weather')
+    assert ns['write_forecast_changes'](forecasts('2024-05-01 09:00', [14.5, 16.1]), engine) == {'inserted': 2, 'updated': 0, 'unchanged': 0}
+    # Three hours later, the 12:00 forecast is the same (NaN rain included), the 15:00 one is warmer.
+    assert ns['write_forecast_changes'](forecasts('2024-05-01 12:00', [14.5, 17.0]), engine) == {'inserted': 1, 'updated': 0, 'unchanged': 1}
+    stored = pd.read_sql('SELECT forecast_time, temperature FROM cities_weather ORDER BY forecast_time, information_retrieved_at', engine)
+    assert stored['temperature'].round(1).tolist() == [14.5, 16.1, 17.0], stored
+    # The latest version of every slot is what the next run compares with.
+    latest = ns['latest_forecasts'](engine, city_ids=[1])
+    assert latest['temperature'].round(1).tolist() == [14.5, 17.0], latest
+    assert ns['forecast_changes'](forecasts('2024-05-01 15:00', [14.5, 17.0]), engine).empty
+
+
+def check_backfill_resume(ns, directory):
+    """A backfill run again after windows failed fetches only the windows not written yet, and a finished backfill fetches nothing."""
+    pd = ns['pd']
+    gans_ledger = ns['gans_ledger']
+    engine = ns['get_engine']('sqlite:///' + os.path.join(directory, 'backfill.db'))
+    ledger = gans_ledger.FileLedger(os.path.join(directory, 'ledger.jsonl'))
+    with open(os.path.join(FIXTURES_DIR, 'aerodatabox_arrivals.json'), encoding='utf-8') as file:
+        record = json.load(file)['arrivals'][0]
+    fetched, failing = [], {('EDDB', '2024-05-02T00:00'), ('EGLL', '2024-05-01T12:00')}
+
+    def fetch_arrivals_window(icao, start, end):
+        # One arrival per window; the windows in 'failing' fail once.
+        window = (icao, f'{start:%Y-%m-%dT%H:%M}')
+        fetched.append(window)
+        if window in failing:
+            failing.discard(window)
+            raise ConnectionError(f'{icao} {start} unreachable')
+        arrival = dict(record, number=f'LH {start:%d%H}', arrival=dict(record['arrival'], scheduledTimeLocal=f'{start:%Y-%m-%d %H}:30+02:00'))
+        return [arrival]
+    fetch = ns['fetch_arrivals_window']
+    ns['fetch_arrivals_window'] = fetch_arrivals_window
+    start_date, end_date = pd.Timestamp('2024-05-01').date(), pd.Timestamp('2024-05-02').date()
+    try:
+        first = ns['backfill_arrivals'](['EDDB', 'EGLL'], start_date, end_date, engine, ledger=ledger, units_per_write=3)
+        assert (first['resumed'], first['written'], first['failed']) == (0, 6, 2), first
+        # Run again: only the two failed windows are fetched.
+        del fetched[:]
+        second = ns['backfill_arrivals'](['EDDB', 'EGLL'], start_date, end_date, engine, ledger=ledger, units_per_write=3)
+        assert (second['resumed'], second['written'], second['failed']) == (6, 2, 0), second
+        assert sorted(fetched) == [('EDDB', '2024-05-02T00:00'), ('EGLL', '2024-05-01T12:00')], fetched
+        # Finished: nothing is fetched, unless the backfill is started over.
+        del fetched[:]
+        assert ns['backfill_arrivals'](['EDDB', 'EGLL'], start_date, end_date, engine, ledger=ledger)['resumed'] == 8
+        assert not fetched, fetched
+        ns['backfill_arrivals'](['EDDB', 'EGLL'], start_date, end_date, engine, ledger=ledger, resume=False)
+        assert len(fetched) == 8, fetched
+    finally:
+        ns['fetch_arrivals_window'] = fetch
+    assert pd.read_sql('SELECT COUNT(*) AS n FROM cities_arrivals', engine)['n'].item() == 8
+
+
+def check_landing_zone_round_trip(ns, directory):
+    """Rows landed as Parquet read back equal, and 'compact' merges the small files without losing rows or the tag of a fetch."""
+    pd = ns['pd']
+    gans_schema = ns['gans_schema']
+    landing_zone = ns['gans_landing'].LandingZone(os.path.join(directory, 'landing'))
+    day = pd.Timestamp('2024-05-01').date()
+    arrivals = gans_schema.enforce(pd.DataFrame({
+        'arrival_airport_icao': ['EDDB', 'EDDB', 'EGLL'], 'flight_number': ['LH 1', 'LH 2', 'BA 1'],
+        'airline': ['Lufthansa', 'Lufthansa', 'British Airways'], 'arrival_time': pd.to_datetime(['2024-05-02 07:20'] * 3, utc=True),
+        'departure_city': ['Frankfurt', 'Munich', 'New York'], 'departure_airport_icao': ['EDDF', 'EDDM', 'KJFK'],
+        'data_retrived_on': pd.to_datetime(['2024-05-01'] * 3)}), 'cities_arrivals')
+
+    # One file per airport, read back with the declared types.
+    assert len(landing_zone.land('cities_arrivals', arrivals, day)) == 2
+    read = landing_zone.read('cities_arrivals', day).sort_values('flight_number', ignore_index=True)
+    pd.testing.assert_frame_equal(read, arrivals.sort_values('flight_number', ignore_index=True), check_categorical=False)
+    assert landing_zone.read('cities_arrivals', day, 'EGLL')['flight_number'].tolist() == ['BA 1']
+
+    # Two more fetches of Berlin, tagged as the Lambda handler does: the three small files of Berlin become two, one per tag.
+    for tag in ['run1', 'run1']:
+        landing_zone.land('cities_arrivals', arrivals.iloc[:1].assign(airline='Eurowings'), day, tag=tag)
+    assert len(landing_zone.files('cities_arrivals', day, 'EDDB')) == 3
+    assert landing_zone.compact('cities_arrivals', day) == 1
+    assert len(landing_zone.files('cities_arrivals', day, 'EDDB')) == 2
+    assert landing_zone.read('cities_arrivals', day)['flight_number'].value_counts().to_dict() == {'LH 1': 3, 'LH 2': 1, 'BA 1': 1}
+    tagged = landing_zone.files('cities_arrivals', day, 'EDDB', tag='run1')
+    assert len(tagged) == 1, tagged
+    assert landing_zone.read_file('cities_arrivals', tagged[0].path).num_rows == 2
+
+    # Loaded into the database, the rows are upserted on their natural key.
+    engine = ns['get_engine']('sqlite:///' + os.path.join(directory, 'landing.db'))
+    write_chunks = ns['write_chunks']
+    assert write_chunks(landing_zone.iter_partition('cities_arrivals', day), 'cities_arrivals', engine)['inserted'] == 3
+    assert pd.read_sql("SELECT airline FROM cities_arrivals WHERE flight_number = 'LH 1'", engine)['airline'].tolist() == ['Eurowings']
+
+
+def check_incremental_features(ns, directory):
+    """After several loads, the 'city_hour_features' rows updated hour by hour equal the features rebuilt from the full history."""
+    pd = ns['pd']
+    gans_schema = ns['gans_schema']
+    engine = ns['get_engine']('sqlite:///' + os.path.join(directory, 'features.db'))
+    ns['sync_table'](pd.DataFrame({'city': ['Berlin', 'London'], 'country': ['Germany', 'United Kingdom'], 'latitude': [52.52, 51.51],
+                                   'longitude': [13.4, -0.13], 'population': [3850809, 8866180], 'city_id': [1, 2]}), 'cities_info', engine)
+    ns['sync_table'](pd.DataFrame({'airport_icao': ['EDDB', 'EGLL', 'LEBL'], 'airport_name': ['Berlin', 'Heathrow', 'Barcelona'],
+                                   'country_code': ['DE', 'GB', 'ES'], 'latitude': [52.36, 51.47, 41.3], 'longitude': [13.5, -0.45, 2.08]}),
+                     'cities_airports', engine)
+
+    def forecasts(retrieved_at, city_id, start, temperatures):
+        # Consecutive 3-hour forecasts of a city from 'start', retrieved at 'retrieved_at'.
+        count = len(temperatures)
+        return gans_schema.enforce(pd.DataFrame({
+            'city_id': [city_id] * count, 'country': ['DE'] * count, 'forecast_time': pd.date_range(start, periods=count, freq='3h', tz='UTC'),
+            'weather': ['Clouds'] * count, 'temperature': temperatures, 'temperature_feels_like': temperatures, 'clouds': [75] * count,
+            'rain': [0.0] * count, 'snow': [0.0] * count, 'wind_speed': [3.1] * count, 'humidity': [60] * count, 'pressure': [1012] * count,
+            'information_retrieved_at': [pd.Timestamp(retrieved_at, tz='UTC')] * count}), 'cities_weather')
+
+    def arrivals(icao, times):
+        # One arrival at every time, at the airport 'icao' (LEBL is farther than AIRPORT_CITY_MAX_KM from every city).
+        return gans_schema.enforce(pd.DataFrame({
+            'arrival_airport_icao': [icao] * len(times), 'flight_number': [f'{icao} {i}' for i in range(len(times))],
+            'airline': ['Lufthansa'] * len(times), 'arrival_time': pd.to_datetime(times, utc=True), 'departure_city': ['Frankfurt'] * len(times),
+            'departure_airport_icao': ['EDDF'] * len(times), 'data_retrived_on': pd.to_datetime(['2024-05-01'] * len(times))}), 'cities_arrivals')
+    loads = [
+        (forecasts('2024-05-01 09:00', 1, '2024-05-02 00:00', [10.0, 11.0, 12.0]), arrivals('EDDB', ['2024-05-02 01:10', '2024-05-02 01:50', '2024-05-02 10:00'])),
+        (forecasts('2024-05-01 12:00', 1, '2024-05-02 03:00', [11.0, 13.5, 14.0]), arrivals('EGLL', ['2024-05-02 04:30', '2024-05-02 23:00'])),
+        (forecasts('2024-05-01 12:00', 2, '2024-05-02 00:00', [8.0, 9.0]), arrivals('LEBL', ['2024-05-02 02:00'])),
+    ]
+    for weather, flights in loads:
+        ns['upsert_dataframe'](weather, 'cities_weather', engine)
+        ns['upsert_dataframe'](flights, 'cities_arrivals', engine)
+        ns['update_features'](engine, ns['affected_hours'](engine, weather=weather, arrivals=flights))
+
+    incremental = gans_schema.enforce(pd.read_sql_table('city_hour_features', engine), 'city_hour_features')
+    incremental = incremental.sort_values(['city_id', 'feature_hour'], ignore_index=True)
+    full = ns['build_features'](engine)
+    pd.testing.assert_frame_equal(incremental, full, check_categorical=False)
+    # Berlin's hours 3-5 have the second version of their slot, and its 01:00 hour two arrivals.
+    berlin = full[full['city_id'] == 1].set_index(full['feature_hour'].dt.hour[full['city_id'] == 1])
+    assert berlin.loc[[0, 3, 6, 9], 'temperature'].tolist() == [10.0, 11.0, 13.5, 14.0], berlin
+    assert berlin.loc[1, 'arrivals'] == 2 and berlin.loc[10, 'arrivals'] == 1, berlin
+    assert ns['update_features'](engine) == {'hours': len(full), 'rows': len(full)}
+
+
+def check_extractor_json_normalize_parity(ns, directory):
+    """The compiled extractors read the same values as 'pd.json_normalize' from the recorded responses, including missing fields."""
+    pd = ns['pd']
+    with open(os.path.join(FIXTURES_DIR, 'openweathermap_forecast.json'), encoding='utf-8') as file:
+        forecasts = json.load(file)['list']
+    with open(os.path.join(FIXTURES_DIR, 'aerodatabox_airports.json'), encoding='utf-8') as file:
+        airports = json.load(file)['items']
+    with open(os.path.join(FIXTURES_DIR, 'aerodatabox_arrivals.json'), encoding='utf-8') as file:
+        arrivals = json.load(file)['arrivals']
+    # A flight from an airport without an ICAO code, and a forecast without its weather.
+    arrivals = arrivals + [dict(arrivals[0], departure={'airport': {'name': 'Nowhere'}})]
+    forecasts = forecasts + [{key: value for key, value in forecasts[0].items() if key != 'weather'}]
+
+    for fields, extractor, records in [(ns['WEATHER_FIELDS'], ns['FORECAST_EXTRACTOR'], forecasts),
+                                       (ns['AIRPORT_FIELDS'], ns['AIRPORT_EXTRACTOR'], airports),
+                                       (ns['ARRIVAL_FIELDS'], ns['ARRIVAL_EXTRACTOR'], arrivals)]:
+        columns = extractor(records)
+        normalized = pd.json_normalize(records)
+        for column, path, dtype, default in fields:
+            if '.0.' in path:
+                # json_normalize keeps lists as they are: read the first item of the list.
+                head, tail = path.split('.0.')
+                expected = normalized[head].map(lambda items: items[0][tail] if isinstance(items, list) and items else None)
+            else:
+                expected = normalized[path] if path in normalized else pd.Series([None] * len(records))
+            if default is not None:
+                expected = expected.fillna(default)
+            if dtype.startswith('datetime64[ns, '):
+                expected = pd.to_datetime(expected, utc=True)
+            elif dtype.startswith('datetime'):
+                expected = pd.to_datetime(expected)
+            else:
+                expected = expected.astype(object).where(expected.notna(), None)
+            actual = pd.Series(columns[column]).astype(expected.dtype if dtype.startswith('datetime') else object)
+            if not dtype.startswith('datetime'):
+                actual = actual.where(actual.notna(), None)
+                if dtype.startswith('float'):
+                    # The extractor stores float32: compare at that precision.
+                    expected = expected.map(lambda value: None if value is None else float(pd.array([value], dtype=dtype)[0]))
+            assert actual.tolist() == expected.tolist(), (column, actual.tolist()[:5], expected.tolist()[:5])
+
+
+def lambda_module(directory, server):
+    """Returns the Lambda handler module, set up to call the stub server and to write to a new database in 'directory', without a ledger."""
+    base_url = f'http://127.0.0.1:{server.server_address[1]}'
+    os.environ.update({'GANS_DB_URL': 'sqlite:///' + os.path.join(directory, 'lambda.db'), 'GANS_LEDGER': 'off',
+                       'OPENWEATHER_URL': base_url + '/data/2.5/forecast', 'AERODATABOX_URL': base_url})
+    import lambda_function
+    lambda_function.OPENWEATHER_URL, lambda_function.AERODATABOX_URL = os.environ['OPENWEATHER_URL'], base_url
+    lambda_function.LEDGER_STORE = 'off'
+    lambda_function.reset_clients()
+    return lambda_function
+
+
+def check_lambda_legacy_table(ns, directory):
+    """The Lambda handler upserts into a table appended by the notebook's old runs, without a unique index on its natural key."""
+    pd = ns['pd']
+    server = start_stub_server(0)
+    lambda_function = lambda_module(directory, server)
+    try:
+        event = {'stages': ['arrivals'], 'icao_list': ['EDDB'], 'mode': 'sequential'}
+        lambda_function.lambda_handler(event, None)
+        arrivals = pd.read_sql_table('cities_arrivals', lambda_function.get_engine())
+        # Store every arrival twice, as appends did, in a table without the unique index.
+        with lambda_function.get_engine().begin() as connection:
+            connection.exec_driver_sql('DROP TABLE cities_arrivals')
+        pd.concat([arrivals, arrivals]).to_sql('cities_arrivals', lambda_function.get_engine(), index=False,
+                                               dtype=ns['gans_schema'].column_types('cities_arrivals'))
+
+        body = json.loads(lambda_function.lambda_handler(event, None)['body'])
+        assert not body['failed_units'], body
+        stored = pd.read_sql_table('cities_arrivals', lambda_function.get_engine())
+        assert len(stored) == len(arrivals), (len(stored), len(arrivals))
+        assert not stored.duplicated(subset=ns['NATURAL_KEYS']['cities_arrivals']).any()
+    finally:
+        lambda_function.get_engine().dispose()
+        lambda_function.reset_clients()
+        server.shutdown()
+
+
+def check_lambda_rate_limit_and_quota(ns, directory):
+    """The Lambda handler keeps to the rate limit of a host, counts its calls in the 'api_usage' table, and stops at the monthly quota."""
+    server = start_stub_server(0)
+    lambda_function = lambda_module(directory, server)
+    host = lambda_function.host_of(lambda_function.OPENWEATHER_URL)
+    rate_limits, monthly_quotas = dict(lambda_function.RATE_LIMITS), dict(lambda_function.MONTHLY_QUOTAS)
+    lambda_function.RATE_LIMITS[host] = (4.0, 1)
+    lambda_function.MONTHLY_QUOTAS[host] = 6
+    event = {'stages': ['weather'], 'cities': ['Berlin', 'London', 'Barcelona', 'Cagliari', 'Amsterdam'], 'mode': 'sequential'}
+    try:
+        start = time.perf_counter()
+        body = json.loads(lambda_function.lambda_handler(event, None)['body'])
+        # 5 calls, 4 per second after the first one.
+        assert time.perf_counter() - start >= 1.0, time.perf_counter() - start
+        assert not body['failed_units'], body
+
+        # The next run only has 1 call left this month: the other cities fail without being called.
+        body = json.loads(lambda_function.lambda_handler(event, None)['body'])
+        assert [failure['error'].split(':')[0] for failure in body['failed_units']] == ['QuotaExceededError'] * 4, body
+        assert lambda_function.get_rate_limiter().calls_this_month(host) == 6
+    finally:
+        lambda_function.RATE_LIMITS.update(rate_limits)
+        lambda_function.MONTHLY_QUOTAS.clear()
+        lambda_function.MONTHLY_QUOTAS.update(monthly_quotas)
+        lambda_function.get_engine().dispose()
+        lambda_function.reset_clients()
+        server.shutdown()
+
+
+def check_infobox_population_priority(ns, directory):
+    """The population is read from the first infobox parameter with a value, and a city without any is skipped instead of failing the batch."""
+    wikitext = {
+        'Total': '{{Infobox settlement\n| population_est = 100\n| population_total = 3,850,809<ref>x</ref>\n}}',
+        'Empty total': '{{Infobox settlement\n| population_total =\n| population_urban = 1,234\n| population_est = 999\n}}',
+        'Estimate only': '{{Infobox settlement\n| subdivision_name = [[Italy]]\n| population_est = {{formatnum:5,000}} (2020)\n}}',
+        'No population': '{{Infobox settlement\n| subdivision_name = [[Spain]]\n| population_note = unknown\n}}',
+    }
+    populations = {title: ns['parse_infobox_wikitext'](text)['population'] for title, text in wikitext.items()}
+    assert populations == {'Total': '3,850,809', 'Empty total': '1,234', 'Estimate only': '5,000', 'No population': None}, populations
+
+    # Answer the batched request of 'recreate_wiki_api' with these pages.
+    class Response:
+        def json(self):
+            return {'query': {'pages': [{'title': title, 'coordinates': [{'lat': 52.52, 'lon': 13.4}],
+                                         'revisions': [{'slots': {'main': {'content': text}}}]}
+                                        for title, text in wikitext.items()]}}
+    api_get = ns['api_get']
+    ns['api_get'] = lambda url, **kwargs: Response()
+    ns['CITY_IDS'].update({title: 900 + i for i, title in enumerate(wikitext)})
+    ns['FAILED_UNITS'].clear()
+    try:
+        cities_info = ns['recreate_wiki_api'](list(wikitext))
+    finally:
+        ns['api_get'] = api_get
+    assert cities_info['population'].tolist() == [3850809, 1234, 5000], cities_info
+    assert [failure['unit'] for failure in ns['FAILED_UNITS']] == ['No population'], ns['FAILED_UNITS']
+
+
+def check_sharded_shared_rate_limit(ns, directory):
+    """The workers of a sharded run share the rate limit of a host, instead of each calling it at the full rate."""
+    server = start_stub_server(0)
+    lambda_function = lambda_module(directory, server)
+    host = lambda_function.host_of(lambda_function.OPENWEATHER_URL)
+    rate_limits = dict(lambda_function.RATE_LIMITS)
+    lambda_function.RATE_LIMITS[host] = (5.0, 1)
+    event = {'stages': ['weather'], 'cities': [f'City{i:02d}' for i in range(11)], 'mode': 'sharded', 'shards': 4, 'shard_executor': 'process'}
+    try:
+        start = time.perf_counter()
+        body = json.loads(lambda_function.lambda_handler(event, None)['body'])
+        seconds = time.perf_counter() - start
+        assert not body['failed_units'], body
+        # 11 calls at 5 per second take at least 2 seconds, whatever the number of workers.
+        assert seconds >= 2.0, seconds
+    finally:
+        lambda_function.RATE_LIMITS.update(rate_limits)
+        lambda_function.get_engine().dispose()
+        lambda_function.reset_clients()
+        server.shutdown()
+
+
+def check_scheduler_failed_units(ns, directory):
+    """A run whose units failed is not recorded as a success, and runs again at its next due time although its load looks fresh."""
+    gans_scheduler = ns['gans_scheduler']
+    failed = [['London'], [], ['London']]
+    runs = []
+
+    def load(scheduled_at):
+        runs.append(scheduled_at)
+        return failed[len(runs) - 1]
+    job = gans_scheduler.Job('weather', load, '0 */3 * * *', fresh_for=ns['timedelta'](hours=2))
+    scheduler = gans_scheduler.Scheduler([job], state_file=os.path.join(directory, 'state.json'))
+
+    scheduler.run_once()
+    assert scheduler.load_state()['weather']['last_error'] == '1 units failed', scheduler.load_state()
+    assert 'last_success' not in scheduler.load_state()['weather']
+    # Not fresh after a failed run: the next run loads again, and succeeds.
+    scheduler.run_once()
+    assert len(runs) == 2 and scheduler.load_state()['weather']['last_error'] is None, scheduler.load_state()
+    # Fresh after the success: skipped.
+    scheduler.run_once()
+    assert len(runs) == 2
+    # A job allowing one failed unit counts the run as a success.
+    job.max_failed_units = 1
+    job.fresh_for = None
+    scheduler.run_once()
+    assert len(runs) == 3 and scheduler.load_state()['weather']['last_error'] is None, scheduler.load_state()
+
+
+def parse_outcome(parse, content):
+    """Returns the values parsed from a page, or the name of the exception raised while parsing it."""
+    try:
+        return parse(content)
+    except Exception as error:
+        return type(error).__name__
+
+
+def check_wiki_parser_parity(ns, directory):
+    """'parse_wiki_infobox' returns the same values as 'parse_wiki_page' (or fails the same way) on pages laid out differently."""
+    pages_dir = os.path.join(FIXTURES_DIR, 'wikipedia_pages')
+    with open(os.path.join(pages_dir, 'expected.json'), encoding='utf-8') as file:
+        expected = json.load(file)
+    paths = {os.path.join(pages_dir, name): values for name, values in expected.items()}
+    # The page served to the benchmarks.
+    paths[os.path.join(FIXTURES_DIR, 'wikipedia_city.html')] = {'city': 'Berlin', 'country': 'Germany', 'latitude': '52°31′12″N',
+                                                                'longitude': '13°24′18″E', 'population': '3,850,809'}
+    for path, values in paths.items():
+        name = os.path.basename(path)
+        with open(path, 'rb') as file:
+            content = file.read()
+        page = parse_outcome(ns['parse_wiki_page'], content)
+        infobox = parse_outcome(ns['parse_wiki_infobox'], content)
+        assert page == values, (name, page, values)
+        assert infobox == page, (name, infobox, page)
+
+
+def check_wiki_cache_parser_version(ns, directory):
+    """The page cache doesn't return values parsed by another parser or version, and counts its metadata in its size."""
+    requests, parses = [], []
+
+    # Answer every request with the page, or '304 Not Modified' when the cached copy is revalidated.
+    class Response:
+        def __init__(self, url, headers):
+            self.status_code = 304 if headers.get('If-None-Match') == '"v1"' else 200
+            self.content = b'' if self.status_code == 304 else url.encode('utf-8') * 10
+            self.headers = {'ETag': '"v1"'}
+    api_get = ns['api_get']
+    ns['api_get'] = lambda url, headers=None: requests.append(url) or Response(url, headers or {})
+
+    def parse_title(content):
+        parses.append('title')
+        return {'title': content[:20].decode('utf-8'), 'padding': 'x' * 1000}
+
+    def parse_length(content):
+        parses.append('length')
+        return {'length': len(content)}
+    url = 'https://en.wikipedia.org/wiki/Berlin'
+    try:
+        cache = ns['HttpCache'](directory, 10 ** 6, version=1)
+        assert cache.fetch(url, parse_title)['title'] == url[:20]
+        assert cache.fetch(url, parse_title)['title'] == url[:20]
+        assert (len(requests), parses) == (2, ['title']), (requests, parses)
+        # Another parser: the cached page is parsed again, without downloading it.
+        assert cache.fetch(url, parse_length) == {'length': len(url) * 10}
+        assert (len(requests), parses) == (3, ['title', 'length']), (requests, parses)
+        # A new version of the parser, even within the ttl.
+        cache = ns['HttpCache'](directory, 10 ** 6, version=2)
+        assert cache.fetch(url, parse_length, ttl=3600) == {'length': len(url) * 10}
+        assert cache.fetch(url, parse_length, ttl=3600) == {'length': len(url) * 10}
+        assert (len(requests), parses) == (3, ['title', 'length', 'length']), (requests, parses)
+
+        # The bodies of two pages take 720 bytes, their metadata more than 2000: only the last page fits in 1500 bytes.
+        cache = ns['HttpCache'](os.path.join(directory, 'small'), 1500)
+        cache.fetch(url, parse_title)
+        cache.fetch(url.replace('Berlin', 'London'), parse_title)
+        assert not any(os.path.exists(path) for path in cache.paths(url)), os.listdir(cache.directory)
+        size = sum(os.path.getsize(os.path.join(cache.directory, name)) for name in os.listdir(cache.directory))
+        assert size <= 1500, size
+    finally:
+        ns['api_get'] = api_get
+
+
+def check_airport_cache_full_search(ns, directory):
+    """A location whose search returned the maximum number of airports is answered from the cache on the next run, correctly."""
+    haversine_km = ns['haversine_km']
+    # A dense area of 40 airports around (52, 13), and 3 airports around (38, 9).
+    airports = [{'icao': f'ED{i:02d}', 'location': {'lat': 52 + (i % 8) * 0.1, 'lon': 13 + (i // 8) * 0.15}} for i in range(40)]
+    airports += [{'icao': f'LI{i:02d}', 'location': {'lat': 38 + i * 0.2, 'lon': 9.0}} for i in range(3)]
+
+    def api_search(lat, lon, radius_km=100, limit=16):
+        # What the location search of the API returns: the nearest airports within the radius, at most 'limit'.
+        distances = sorted((haversine_km(lat, lon, item['location']['lat'], item['location']['lon']), item['icao'], item) for item in airports)
+        return [item for distance, icao, item in distances if distance <= radius_km][:limit]
+    path = os.path.join(directory, 'airport_cache.json')
+    cache = ns['AirportCache'](path)
+    for lat, lon in [(52.3, 13.3), (38.1, 9.1)]:
+        assert cache.search(lat, lon, 100, 16) is None
+        cache.add(api_search(lat, lon), lat, lon, 100, 16)
+        assert cache.search(lat, lon, 100, 16) == api_search(lat, lon), (lat, lon)
+    cache.save()
+
+    # Reloaded from the file: the same locations are still answered, and every answer is what the API would return.
+    cache = ns['AirportCache'](path)
+    assert len(api_search(52.3, 13.3)) == 16
+    assert cache.search(52.3, 13.3, 100, 16) == api_search(52.3, 13.3)
+    assert cache.search(38.1, 9.1, 100, 16) == api_search(38.1, 9.1)
+    for d_lat in range(-10, 11):
+        for d_lon in range(-10, 11):
+            lat, lon = 52.3 + d_lat * 0.05, 13.3 + d_lon * 0.05
+            items = cache.search(lat, lon, 100, 16)
+            assert items is None or items == api_search(lat, lon), (lat, lon)
+
+
+def check_arrivals_freshness(ns, directory):
+    """Only tomorrow's arrivals make the arrivals job fresh: a backfill of past days, stamped with today's date, doesn't."""
+    pd = ns['pd']
+    timedelta = ns['timedelta']
+    scheduler_timezone = ns['gans_scheduler'].SCHEDULER_TIMEZONE
+    ns['engine'] = ns['get_engine']('sqlite:///' + os.path.join(directory, 'arrivals.db'))
+    today = pd.Timestamp.now(tz=scheduler_timezone).normalize()
+
+    def arrivals(day, retrieved_on, flight_number):
+        # One arrival at noon in Berlin on 'day', retrieved on 'retrieved_on'.
+        return pd.DataFrame({'arrival_airport_icao': ['EDDB'], 'flight_number': [flight_number], 'airline': ['Lufthansa'],
+                             'arrival_time': [(day + timedelta(hours=12)).tz_convert('UTC')], 'departure_city': ['Frankfurt'],
+                             'departure_airport_icao': ['EDDF'], 'data_retrived_on': [retrieved_on.tz_localize(None)]})
+    assert ns['arrivals_loaded_at']() is None
+    # A backfill of the past week, run today.
+    for days in range(1, 8):
+        ns['upsert_dataframe'](arrivals(today - timedelta(days=days), today, f'LH {days}'), 'cities_arrivals', ns['engine'])
+    assert ns['arrivals_loaded_at']() is None, ns['arrivals_loaded_at']()
+    # Tomorrow's arrivals retrieved yesterday (e.g. a day-ahead load), then today.
+    ns['upsert_dataframe'](arrivals(today + timedelta(days=1), today - timedelta(days=1), 'LH 100'), 'cities_arrivals', ns['engine'])
+    assert ns['arrivals_loaded_at']() == today - timedelta(days=1), ns['arrivals_loaded_at']()
+    ns['upsert_dataframe'](arrivals(today + timedelta(days=1), today, 'LH 101'), 'cities_arrivals', ns['engine'])
+    assert ns['arrivals_loaded_at']() == today, ns['arrivals_loaded_at']()
+
+
+def check_recreate_wiki_partial_results(ns, directory):
+    """A city whose page has no population, or no infobox, is recorded as failed and skipped: the other cities are still returned."""
+    pages_dir = os.path.join(FIXTURES_DIR, 'wikipedia_pages')
+    pages = {'Berlin': os.path.join(FIXTURES_DIR, 'wikipedia_city.html'),
+             'London': os.path.join(pages_dir, 'london_population_with_reference.html'),
+             'Cagliari': os.path.join(pages_dir, 'cagliari_no_population.html'),
+             'Gdansk': os.path.join(pages_dir, 'gdansk_population_unknown.html'),
+             'Springfield': os.path.join(pages_dir, 'disambiguation_no_infobox.html')}
+
+    class Response:
+        def __init__(self, url):
+            with open(pages[url.rsplit('/', 1)[1]], 'rb') as file:
+                self.content = file.read()
+    api_get = ns['api_get']
+    ns['api_get'] = lambda url, **kwargs: Response(url)
+    ns['CITY_IDS'].update({'Springfield': 950})
+    ns['FAILED_UNITS'].clear()
+    try:
+        cities_info = ns['recreate_wiki'](list(pages), use_cache=False)
+    finally:
+        ns['api_get'] = api_get
+    assert cities_info['city'].tolist() == ['Berlin', 'London'], cities_info
+    assert cities_info['population'].tolist() == [3850809, 8866180], cities_info
+    assert [failure['unit'] for failure in ns['FAILED_UNITS']] == ['Cagliari', 'Gdansk', 'Springfield'], ns['FAILED_UNITS']
+
+
+CHECKS = {
+    'natural_key_duplicates': check_natural_key_duplicates,
+    'legacy_table_migration': check_legacy_table_migration,
+    'sync_table': check_sync_table,
+    'forecast_changes': check_forecast_changes,
+    'lambda_legacy_table': check_lambda_legacy_table,
+    'infobox_population_priority': check_infobox_population_priority,
+    'lambda_rate_limit_and_quota': check_lambda_rate_limit_and_quota,
+    'sharded_shared_rate_limit': check_sharded_shared_rate_limit,
+    'scheduler_failed_units': check_scheduler_failed_units,
+    'arrivals_freshness': check_arrivals_freshness,
+    'backfill_resume': check_backfill_resume,
+    'landing_zone_round_trip': check_landing_zone_round_trip,
+    'incremental_features': check_incremental_features,
+    'wiki_parser_parity': check_wiki_parser_parity,
+    'extractor_json_normalize_parity': check_extractor_json_normalize_parity,
+    'recreate_wiki_partial_results': check_recreate_wiki_partial_results,
+    'wiki_cache_parser_version': check_wiki_cache_parser_version,
+    'airport_cache_full_search': check_airport_cache_full_search,
+}
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--checks', nargs='+', choices=list(CHECKS), default=list(CHECKS))
+    args = parser.parse_args()
+
+    ns = load_pipeline()
+    failed = 0
+    for name in args.checks:
+        with tempfile.TemporaryDirectory() as directory:
+            try:
+                CHECKS[name](ns, directory)
+            except Exception:
+                failed += 1
+                print(f'FAIL {name}')
+                traceback.print_exc()
+            else:
+                print(f'ok   {name}')
+    return 1 if failed else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
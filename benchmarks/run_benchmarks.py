@@ -0,0 +1,454 @@
+"""
+Offline replay benchmarks for the GANS data pipeline.
+
+The pipeline stages defined in GANS-data_engineering.py are run against recorded API
+responses (benchmarks/fixtures) served by a local HTTP stub, with a SQLite database
+standing in for the RDS MySQL instance, so no API key, quota or network is needed.
+
+The 'static_sync' stage times refreshing the static tables when nothing changed.
+
+The 'arrivals_replayed' stage loads one day of arrivals into the database from the Parquet
+landing zone instead of the APIs (compare with 'arrivals_materialized', which fetches them).
+
+The feature stages start from FEATURE_HISTORY_DAYS daily loads of 'size' cities and one more
+load. 'features_full_join' times joining the weather, arrivals, airports and cities of the whole
+history to get the features of every city hour; 'features_table' times reading the same features
+from the 'city_hour_features' table, and 'features_incremental' times updating that table in the
+hours of the last load, which the pipeline pays once per load.
+
+The Lambda handler (lambda_function.py) is timed end to end, fetching and writing the
+weather of 'size' cities and the arrivals of 'size' airports, in its sequential and
+pipelined modes, and in its sharded mode with 1, 2 and 4 worker processes: compare the
+'lambda_sharded_*' stages to see how the throughput scales with the number of workers.
+The workers overlap the latency of the APIs, so the scaling shows best with a realistic
+latency (--latency-ms 200), or on a machine with at least as many cores as workers. The
+baseline keeps the results of the default latency of DEFAULT_LATENCY_MS under 'stage@size',
+and those of another latency under 'stage@size@<latency>ms', e.g. 'lambda_sharded_4@500@200ms'.
+
+Every stage is timed at 5, 50 and 500 cities, each run in a fresh process and working
+directory (so caches start empty and peak memory is measured per run). For every run
+the script reports the wall time, the throughput (cities, airports or rows per second),
+the p50/p99 latency of the HTTP requests and the peak RSS of the process, and compares
+them with benchmarks/baseline.json.
+
+Usage:
+    python benchmarks/run_benchmarks.py                     # run and compare with the baseline
+    python benchmarks/run_benchmarks.py --update-baseline   # run and save the results as the new baseline
+    python benchmarks/run_benchmarks.py --stages get_weather_loop --sizes 5 50
+    python benchmarks/run_benchmarks.py --stages lambda_sharded_1 lambda_sharded_4 --sizes 50 --latency-ms 200
+"""
+import argparse
+import ast
+import json
+import os
+import resource
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlparse
+
+BENCHMARKS_DIR = os.path.dirname(os.path.abspath(__file__))
+FIXTURES_DIR = os.path.join(BENCHMARKS_DIR, 'fixtures')
+BASELINE_FILE = os.path.join(BENCHMARKS_DIR, 'baseline.json')
+REPO_DIR = os.path.dirname(BENCHMARKS_DIR)
+NOTEBOOK_EXPORT = os.path.join(REPO_DIR, 'GANS-data_engineering.py')
+
+SIZES = [5, 50, 500]
+
+# Network latency simulated by the stub server by default, in milliseconds.
+DEFAULT_LATENCY_MS = 20.0
+
+# Path prefix of every stubbed endpoint, with the fixture it answers and its content type.
+ROUTES = [
+    ('/data/2.5/forecast', 'openweathermap_forecast.json', 'application/json'),
+    ('/airports/search/location/', 'aerodatabox_airports.json', 'application/json'),
+    ('/flights/airports/icao/', 'aerodatabox_arrivals.json', 'application/json'),
+    ('/wiki/', 'wikipedia_city.html', 'text/html; charset=UTF-8'),
+]
+
+
+def load_pipeline(path=NOTEBOOK_EXPORT):
+    """
+    Loads the pipeline functions from the notebook export without running its cells.
+
+    Only the imports, the function and class definitions and the UPPER_CASE constants
+    are executed: the cells reading credentials from disk, calling the APIs or writing
+    to the database are skipped.
+
+    Returns:
+    - dict: The namespace of the notebook, with dummy API keys.
+    """
+    # The notebook imports modules living next to it, e.g. gans_schema.
+    if REPO_DIR not in sys.path:
+        sys.path.insert(0, REPO_DIR)
+    tree = ast.parse(open(path, encoding='utf-8').read(), path)
+    keep = [node for node in tree.body
+            if isinstance(node, (ast.Import, ast.ImportFrom, ast.FunctionDef, ast.ClassDef))
+            or (isinstance(node, ast.Assign)
+                and all(isinstance(target, ast.Name) and target.id.isupper() for target in node.targets))]
+    namespace = {'__name__': 'gans_pipeline', 'my_API_key': 'benchmark', 'my_API_key2': 'benchmark'}
+    exec(compile(ast.Module(keep, type_ignores=[]), path, 'exec'), namespace)
+    return namespace
+
+
+class StubHandler(BaseHTTPRequestHandler):
+    """Answers every request with the fixture of its route, after the configured network latency."""
+    protocol_version = 'HTTP/1.1'
+    # Headers and body are written separately: without this, Nagle and delayed ACKs add ~40 ms per request.
+    disable_nagle_algorithm = True
+    fixtures = {}
+    latency = 0.0
+
+    def do_GET(self):
+        path = urlparse(self.path).path
+        for prefix, fixture, content_type in ROUTES:
+            if path.startswith(prefix):
+                body = self.fixtures[fixture]
+                time.sleep(self.latency)
+                self.send_response(200)
+                self.send_header('Content-Type', content_type)
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+                return
+        self.send_error(404)
+
+    def log_message(self, format, *args):
+        pass
+
+
+def start_stub_server(latency):
+    """Starts the stub server on a free local port, in a background thread, and returns it."""
+    StubHandler.latency = latency
+    for _, fixture, _ in ROUTES:
+        with open(os.path.join(FIXTURES_DIR, fixture), 'rb') as file:
+            StubHandler.fixtures[fixture] = file.read()
+    # Accept the connections of many workers at once: with the default backlog of 5, dropped connections are retried after 1 s.
+    ThreadingHTTPServer.request_queue_size = 128
+    server = ThreadingHTTPServer(('127.0.0.1', 0), StubHandler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+def read_fixture(name):
+    with open(os.path.join(FIXTURES_DIR, name), 'r', encoding='utf-8') as file:
+        return json.load(file)
+
+
+def bench_recreate_wiki(ns, size):
+    cities = [f'City{i:03d}' for i in range(size)]
+    # Every city needs a stable id.
+    ns['CITY_IDS'].update({city: 100 + i for i, city in enumerate(cities)})
+    ns['recreate_wiki'](cities)
+    return size
+
+
+def bench_get_weather_loop(ns, size):
+    ns['get_weather_loop']([f'City{i:03d}' for i in range(size)])
+    return size
+
+
+def bench_icao_airport_codes(ns, size):
+    # Locations far enough from each other for their 100 km search circles not to overlap.
+    latitudes = [-50 + 2.5 * (i // 40) for i in range(size)]
+    longitudes = [-170 + 8.5 * (i % 40) for i in range(size)]
+    ns['icao_airport_codes'](latitudes, longitudes)
+    return size
+
+
+def bench_tomorrows_flight_arrivals(ns, size):
+    ns['tomorrows_flight_arrivals']([f'K{i:03d}' for i in range(size)])
+    return size
+
+
+def bench_to_sql(ns, size):
+    # Build the frames of 'size' cities from the fixtures, without HTTP, then time only the writes.
+    pd = ns['pd']
+    forecast = read_fixture('openweathermap_forecast.json')
+    arrivals = read_fixture('aerodatabox_arrivals.json')['arrivals']
+    cities_weather = ns['parse_forecasts']([forecast] * size, list(range(1, size + 1)), ns['datetime'](2023, 3, 7))
+    cities_arrivals = pd.concat([ns['arrivals_to_dataframe'](arrivals, f'K{i:03d}') for i in range(size)], ignore_index=True)
+    cities_info = pd.DataFrame({'city': [f'City{i:03d}' for i in range(size)], 'country': 'Germany',
+                                'latitude': 52.31, 'longitude': 13.24, 'population': 3850809,
+                                'city_id': [i + 1 for i in range(size)]})
+    engine = ns['get_engine']('sqlite:///benchmark.db')
+
+    start = time.perf_counter()
+    cities_info.to_sql('cities_info', if_exists='append', con=engine, index=False)
+    ns['upsert_dataframe'](cities_weather, 'cities_weather', engine)
+    ns['upsert_dataframe'](cities_arrivals, 'cities_arrivals', engine)
+    bench_to_sql.seconds = time.perf_counter() - start
+    return len(cities_info) + len(cities_weather) + len(cities_arrivals)
+
+
+def bench_arrivals_to_sql(streamed):
+    # Fetch and write the arrivals of 'size' airports over two days, as one DataFrame or streamed window by window.
+    def bench(ns, size):
+        icao_list = [f'K{i:03d}' for i in range(size)]
+        start_date = ns['date'](2023, 3, 7)
+        end_date = start_date + ns['timedelta'](days=1)
+        engine = ns['get_engine']('sqlite:///benchmark.db')
+        if streamed:
+            ns['write_chunks'](ns['iter_flight_arrivals'](icao_list, start_date, end_date), 'cities_arrivals', engine)
+        else:
+            ns['upsert_dataframe'](ns['flight_arrivals'](icao_list, start_date, end_date), 'cities_arrivals', engine)
+        return size
+    return bench
+
+
+def bench_static_sync(ns, size):
+    # Synchronize 'size' cities and their airports into the static tables, then time only the refresh of the unchanged frames.
+    pd = ns['pd']
+    cities_info = pd.DataFrame({'city': [f'City{i:03d}' for i in range(size)], 'country': 'Germany',
+                                'latitude': 52.31, 'longitude': 13.24, 'population': 3850809,
+                                'city_id': [i + 1 for i in range(size)]})
+    items = read_fixture('aerodatabox_airports.json')['items']
+    cities_airports = ns['airports_to_dataframe']([{**item, 'icao': f'K{i:03d}'} for i in range(size) for item in items[:1]])
+    engine = ns['get_engine']('sqlite:///benchmark.db')
+    for table_name, frame in [('cities', cities_info), ('cities_info', cities_info), ('cities_airports', cities_airports)]:
+        ns['sync_table'](frame, table_name, engine)
+
+    start = time.perf_counter()
+    for table_name, frame in [('cities', cities_info), ('cities_info', cities_info), ('cities_airports', cities_airports)]:
+        ns['sync_table'](frame, table_name, engine)
+    bench_static_sync.seconds = time.perf_counter() - start
+    return 3 * size
+
+
+def bench_arrivals_replayed(ns, size):
+    # Land the two windows of one day of 'size' airports from the fixtures, then time only loading the day back from Parquet, without HTTP.
+    arrivals = read_fixture('aerodatabox_arrivals.json')['arrivals']
+    landing_zone = ns['LANDING_ZONE'] = ns['gans_landing'].LandingZone('landing')
+    day = ns['date'](2023, 3, 7)
+    for i in range(size):
+        for window in range(2):
+            landing_zone.land('cities_arrivals', ns['arrivals_to_dataframe'](arrivals, f'K{i:03d}'), day)
+    landing_zone.compact('cities_arrivals', day)
+    engine = ns['get_engine']('sqlite:///benchmark.db')
+
+    start = time.perf_counter()
+    ns['load_partition']('cities_arrivals', day, engine)
+    bench_arrivals_replayed.seconds = time.perf_counter() - start
+    return size
+
+
+# Days of forecasts and arrivals loaded before the feature stages are timed.
+FEATURE_HISTORY_DAYS = 30
+
+
+def load_feature_history(ns, size):
+    # Store 'size' cities, one airport next to each, and FEATURE_HISTORY_DAYS daily loads of their forecasts and arrivals, without HTTP.
+    # Returns the engine and a function building the load of one more day.
+    pd = ns['pd']
+    forecast = read_fixture('openweathermap_forecast.json')
+    arrivals = read_fixture('aerodatabox_arrivals.json')['arrivals']
+    item = read_fixture('aerodatabox_airports.json')['items'][0]
+    cities_info = pd.DataFrame({'city': [f'City{i:03d}' for i in range(size)], 'country': 'Germany',
+                                'latitude': [-60 + i * 0.2 for i in range(size)], 'longitude': 13.24, 'population': 3850809,
+                                'city_id': [i + 1 for i in range(size)]})
+    cities_airports = ns['airports_to_dataframe']([{**item, 'icao': f'K{i:03d}', 'location': {'lat': -60 + i * 0.2, 'lon': 13.3}} for i in range(size)])
+    cities_weather = ns['parse_forecasts']([forecast] * size, list(range(1, size + 1)), ns['datetime'](2023, 3, 7))
+    cities_arrivals = pd.concat([ns['arrivals_to_dataframe'](arrivals, f'K{i:03d}') for i in range(size)], ignore_index=True)
+
+    def load_day(day):
+        # The fixtures moved by 'day' days, as retrieved by the daily load of that day.
+        shift = pd.Timedelta(days=day)
+        return (cities_weather.assign(forecast_time=cities_weather['forecast_time'] + shift,
+                                      information_retrieved_at=cities_weather['information_retrieved_at'] + shift),
+                cities_arrivals.assign(arrival_time=cities_arrivals['arrival_time'] + shift))
+
+    # Stream the history to the tables: every daily load stored a version of each of its forecast slots.
+    engine = ns['get_engine']('sqlite:///benchmark.db')
+    ns['sync_table'](cities_info, 'cities_info', engine)
+    ns['sync_table'](cities_airports, 'cities_airports', engine)
+    for index, table_name in enumerate(['cities_weather', 'cities_arrivals']):
+        ns['write_chunks']((load_day(day)[index] for day in range(FEATURE_HISTORY_DAYS)), table_name, engine, rows_per_write=50000)
+    return engine, load_day
+
+
+def bench_features(stage):
+    # After one more daily load, time what getting the features of every city hour costs:
+    # - 'full_join': joining the weather, arrivals, airports and cities of the whole history again;
+    # - 'incremental': updating the 'city_hour_features' table in the hours of the load, paid once per load;
+    # - 'table': reading the updated table.
+    def bench(ns, size):
+        engine, load_day = load_feature_history(ns, size)
+        if stage != 'full_join':
+            ns['update_features'](engine)
+        cities_weather, cities_arrivals = load_day(FEATURE_HISTORY_DAYS)
+        ns['write_forecast_changes'](cities_weather, engine)
+        ns['upsert_dataframe'](cities_arrivals, 'cities_arrivals', engine)
+        if stage == 'table':
+            ns['update_features'](engine, ns['affected_hours'](engine, weather=cities_weather, arrivals=cities_arrivals))
+
+        start = time.perf_counter()
+        if stage == 'full_join':
+            rows = len(ns['build_features'](engine))
+        elif stage == 'incremental':
+            rows = ns['update_features'](engine, ns['affected_hours'](engine, weather=cities_weather, arrivals=cities_arrivals))['rows']
+        else:
+            rows = len(ns['pd'].read_sql_table('city_hour_features', engine))
+        bench.seconds = time.perf_counter() - start
+        return rows
+    return bench
+
+
+def bench_lambda(mode, shards=None):
+    def bench(ns, size):
+        os.environ['GANS_DB_URL'] = 'sqlite:///benchmark.db'
+        # The worker processes of the sharded mode may import the handler again: give them the stub URLs too.
+        os.environ['OPENWEATHER_URL'] = ns['OPENWEATHER_URL']
+        os.environ['AERODATABOX_URL'] = ns['AERODATABOX_URL']
+        import lambda_function
+        lambda_function.OPENWEATHER_URL = ns['OPENWEATHER_URL']
+        lambda_function.AERODATABOX_URL = ns['AERODATABOX_URL']
+        # Time the requests of the handler like those of the notebook.
+        lambda_function.HTTP_SESSION = ns['HTTP_SESSION']
+        # Every run loads all its units again, instead of resuming the run of the previous size.
+        event = {'cities': [f'City{i:03d}' for i in range(size)], 'icao_list': [f'K{i:03d}' for i in range(size)], 'mode': mode, 'resume': False}
+        if shards:
+            event['shards'] = shards
+        body = json.loads(lambda_function.lambda_handler(event, None)['body'])
+        return sum(body['rows_written'].values())
+    return bench
+
+
+# Stage name, benchmark function and unit of its throughput.
+STAGES = {
+    'recreate_wiki': (bench_recreate_wiki, 'cities'),
+    'get_weather_loop': (bench_get_weather_loop, 'cities'),
+    'icao_airport_codes': (bench_icao_airport_codes, 'locations'),
+    'tomorrows_flight_arrivals': (bench_tomorrows_flight_arrivals, 'airports'),
+    'to_sql': (bench_to_sql, 'rows'),
+    'static_sync': (bench_static_sync, 'rows'),
+    'arrivals_materialized': (bench_arrivals_to_sql(streamed=False), 'airports'),
+    'arrivals_streamed': (bench_arrivals_to_sql(streamed=True), 'airports'),
+    'arrivals_replayed': (bench_arrivals_replayed, 'airports'),
+    'features_full_join': (bench_features('full_join'), 'rows'),
+    'features_incremental': (bench_features('incremental'), 'rows'),
+    'features_table': (bench_features('table'), 'rows'),
+    'lambda_sequential': (bench_lambda('sequential'), 'rows'),
+    'lambda_pipelined': (bench_lambda('pipelined'), 'rows'),
+    'lambda_sharded_1': (bench_lambda('sharded', shards=1), 'rows'),
+    'lambda_sharded_2': (bench_lambda('sharded', shards=2), 'rows'),
+    'lambda_sharded_4': (bench_lambda('sharded', shards=4), 'rows'),
+}
+
+
+def percentile(values, fraction):
+    if not values:
+        return None
+    values = sorted(values)
+    return values[min(len(values) - 1, int(round(fraction * (len(values) - 1))))]
+
+
+def run_child(stage, size, base_url):
+    """Runs one stage at one size in this process and prints its measurements as JSON."""
+    ns = load_pipeline()
+    ns['OPENWEATHER_URL'] = base_url + '/data/2.5/forecast'
+    ns['AERODATABOX_URL'] = base_url
+    ns['WIKIPEDIA_URL'] = base_url + '/wiki'
+
+    # Time every HTTP request sent through the shared session.
+    latencies = []
+    session_get = ns['HTTP_SESSION'].get
+
+    def timed_get(*args, **kwargs):
+        start = time.perf_counter()
+        response = session_get(*args, **kwargs)
+        latencies.append(time.perf_counter() - start)
+        return response
+    ns['HTTP_SESSION'].get = timed_get
+
+    function, unit = STAGES[stage]
+    start = time.perf_counter()
+    units = function(ns, size)
+    seconds = getattr(function, 'seconds', time.perf_counter() - start)
+
+    p50, p99 = percentile(latencies, 0.50), percentile(latencies, 0.99)
+    print(json.dumps({
+        'seconds': round(seconds, 4),
+        'throughput': round(units / seconds, 2),
+        'unit': f'{unit}/s',
+        'requests': len(latencies),
+        'p50_ms': round(p50 * 1000, 2) if p50 is not None else None,
+        'p99_ms': round(p99 * 1000, 2) if p99 is not None else None,
+        # ru_maxrss is in KB on Linux.
+        'peak_rss_mb': round(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024, 1),
+    }))
+
+
+def compare(key, result, baseline, tolerance):
+    """Returns the regressions of a result against its baseline entry."""
+    regressions = []
+    for metric in ['seconds', 'p99_ms', 'peak_rss_mb']:
+        old, new = baseline.get(metric), result.get(metric)
+        if old and new and new > old * (1 + tolerance):
+            regressions.append(f'{key} {metric}: {old} -> {new} (+{(new / old - 1) * 100:.0f}%)')
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--stages', nargs='+', choices=list(STAGES), default=list(STAGES))
+    parser.add_argument('--sizes', nargs='+', type=int, default=SIZES)
+    parser.add_argument('--latency-ms', type=float, default=DEFAULT_LATENCY_MS, help='network latency simulated by the stub server')
+    parser.add_argument('--tolerance', type=float, default=0.25, help='allowed slowdown before a result counts as a regression')
+    parser.add_argument('--update-baseline', action='store_true', help='save the results as the new baseline')
+    parser.add_argument('--child', nargs=3, metavar=('STAGE', 'SIZE', 'BASE_URL'), help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.child:
+        stage, size, base_url = args.child
+        run_child(stage, int(size), base_url)
+        return 0
+
+    server = start_stub_server(args.latency_ms / 1000)
+    base_url = f'http://127.0.0.1:{server.server_address[1]}'
+    baseline = {}
+    if os.path.exists(BASELINE_FILE):
+        with open(BASELINE_FILE, 'r') as file:
+            baseline = json.load(file)
+    # Results at another latency than the default are kept apart.
+    suffix = '' if args.latency_ms == DEFAULT_LATENCY_MS else f'@{args.latency_ms:g}ms'
+
+    results = {}
+    regressions = []
+    print(f"{'stage':<28}{'size':>6}{'seconds':>10}{'throughput':>20}{'p50 ms':>9}{'p99 ms':>9}{'RSS MB':>9}")
+    for stage in args.stages:
+        for size in args.sizes:
+            # Every run gets a fresh process and working directory: empty caches, own peak RSS.
+            with tempfile.TemporaryDirectory() as workdir:
+                output = subprocess.run([sys.executable, os.path.abspath(__file__), '--child', stage, str(size), base_url],
+                                        cwd=workdir, capture_output=True, text=True)
+            if output.returncode != 0:
+                print(output.stderr, file=sys.stderr)
+                raise SystemExit(f'{stage} at {size} cities failed')
+            key = f'{stage}@{size}{suffix}'
+            result = results[key] = json.loads(output.stdout.strip().splitlines()[-1])
+            print(f"{stage:<28}{size:>6}{result['seconds']:>10.3f}{result['throughput']:>12.1f} {result['unit']:<11}"
+                  f"{result['p50_ms'] if result['p50_ms'] is not None else '-':>8}{result['p99_ms'] if result['p99_ms'] is not None else '-':>9}"
+                  f"{result['peak_rss_mb']:>9.1f}")
+            if key in baseline.get('results', {}):
+                regressions += compare(key, result, baseline['results'][key], args.tolerance)
+    server.shutdown()
+
+    if args.update_baseline:
+        baseline = {'latency_ms': DEFAULT_LATENCY_MS, 'results': {**baseline.get('results', {}), **results}}
+        with open(BASELINE_FILE, 'w') as file:
+            json.dump(baseline, file, indent=1, sort_keys=True)
+            file.write('\n')
+        print(f'baseline saved to {BASELINE_FILE}')
+        return 0
+
+    for regression in regressions:
+        print('REGRESSION', regression)
+    return 1 if regressions else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
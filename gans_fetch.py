@@ -0,0 +1,229 @@
+"""
+Fetch logic of the GANS pipeline shared by the notebook and lambda_function.py: the ids of the cities, the retries of
+the API calls, and the time windows of the AeroDataBox flights endpoint.
+
+'get_with_retries' sends a GET request within the rate limit and monthly quota of the host (a
+gans_ratelimit.HostRateLimiter), retries connection errors, timeouts and 5xx answers after a random backoff, pauses
+the host for the 'Retry-After' time of a '429 Too Many Requests' (given in seconds or as an HTTP date), and stops
+calling a host that keeps failing through a CircuitBreaker.
+
+The flights endpoint returns the arrivals of one airport for a window of at most 12 hours, and cuts off the answer of
+a busy window: 'arrival_windows' splits days into windows, and 'fetch_arrivals_window' splits a window again when it
+returns ARRIVALS_PER_REQUEST_CAP arrivals. The request itself is sent by the 'get' function of the caller, e.g. the
+'api_get' of the notebook or of the Lambda handler, with its rate limits.
+"""
+import importlib
+import random
+import threading
+import time
+from datetime import datetime, timedelta, timezone
+from email.utils import parsedate_to_datetime
+from urllib.parse import urlparse
+
+# Id of each city in the 'cities' table, used by all the tables. Ids are never reused for another city.
+CITY_IDS = {'Berlin': 1, 'London': 2, 'Barcelona': 3, 'Cagliari': 4, 'Amsterdam': 5, 'Gdansk': 6}
+
+# Number of times a call is tried again after a connection error, a timeout, or a 429 or 5xx answer, and the base and
+# maximum of the exponential backoff between the tries.
+MAX_RETRIES = 3
+BACKOFF_BASE_SECONDS = 0.5
+BACKOFF_MAX_SECONDS = 30.0
+
+# Seconds to wait for an API to connect and to answer.
+REQUEST_TIMEOUT_SECONDS = 30
+
+# Number of failed calls in a row after which the circuit of a host opens, and seconds before a trial call is let through.
+CIRCUIT_FAILURE_THRESHOLD = 5
+CIRCUIT_COOLDOWN_SECONDS = 60.0
+
+# Number of arrivals above which a window is considered cut off by the API: such a window is split in two and fetched again.
+ARRIVALS_PER_REQUEST_CAP = 1000
+
+# Windows are never split below this length.
+MIN_ARRIVALS_WINDOW = timedelta(hours=1)
+
+
+class CircuitOpenError(Exception):
+    """Raised instead of calling a host whose circuit is open, because its last calls all failed."""
+
+
+class CircuitBreaker:
+    """
+    Thread-safe circuit breaker per host: after 'threshold' failed calls in a row, calls to the host are refused for
+    'cooldown' seconds.
+
+    After the cooldown one trial call is let through (and the next ones refused for another cooldown): if it
+    succeeds, the circuit closes.
+    """
+
+    def __init__(self, threshold=CIRCUIT_FAILURE_THRESHOLD, cooldown=CIRCUIT_COOLDOWN_SECONDS):
+        self.threshold = threshold
+        self.cooldown = cooldown
+        self.failures = {}
+        self.opened_at = {}
+        self.lock = threading.Lock()
+
+    def before_call(self, host):
+        """Raises CircuitOpenError if the circuit of 'host' is open."""
+        with self.lock:
+            opened_at = self.opened_at.get(host)
+            if opened_at is None:
+                return
+            if time.monotonic() - opened_at < self.cooldown:
+                raise CircuitOpenError(f"Circuit of {host} is open after {self.failures[host]} failed calls in a row")
+            # Let this call through as the trial, and keep refusing the others until it is done.
+            self.opened_at[host] = time.monotonic()
+
+    def record(self, host, success):
+        """Counts the result of a call: a success closes the circuit, a failure may open it."""
+        with self.lock:
+            if success:
+                self.failures.pop(host, None)
+                self.opened_at.pop(host, None)
+                return
+            self.failures[host] = self.failures.get(host, 0) + 1
+            if self.failures[host] >= self.threshold:
+                self.opened_at[host] = time.monotonic()
+
+
+def host_of(url):
+    """Returns the host of a URL, as the rate limits and circuits are kept, e.g. 'api.openweathermap.org'."""
+    return urlparse(url).netloc
+
+
+def backoff_seconds(attempt):
+    """Returns a random wait before retry number 'attempt' (from 0): up to BACKOFF_BASE_SECONDS, doubling with every attempt."""
+    # Full jitter: concurrent fetchers that failed together don't retry together.
+    return random.uniform(0, min(BACKOFF_MAX_SECONDS, BACKOFF_BASE_SECONDS * 2 ** attempt))
+
+
+def retry_after_seconds(response, default=1.0):
+    """
+    Reads the 'Retry-After' header of a response, given either in seconds or as an HTTP date.
+
+    Parameters:
+    - response (Response): A '429 Too Many Requests' or '503 Service Unavailable' answer.
+    - default (float): Seconds returned when the header is missing or unreadable.
+
+    Returns:
+    - float: Seconds to wait, never negative.
+    """
+    value = response.headers.get('Retry-After')
+    if value is None:
+        return default
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        pass
+    try:
+        return max(0.0, (parsedate_to_datetime(value) - datetime.now(timezone.utc)).total_seconds())
+    except (TypeError, ValueError):
+        return default
+
+
+def get_with_retries(session, url, rate_limiter, circuit_breaker, **kwargs):
+    """
+    Sends a GET request within the rate limit and monthly quota of the host, retrying transient failures.
+
+    Parameters:
+    - session (Session): requests session sending the request.
+    - url (str): URL of the request.
+    - rate_limiter (HostRateLimiter): Rate limits and monthly quotas of the hosts (see gans_ratelimit.py).
+    - circuit_breaker (CircuitBreaker): Failed calls of the hosts.
+    - **kwargs: Passed on to 'requests', e.g. 'headers' and 'params'.
+
+    Returns:
+    - Response: The successful response (status below 400).
+
+    Raises:
+    - requests.HTTPError: The API answered with an error, still after MAX_RETRIES retries for a 429 or 5xx.
+    - requests.ConnectionError, requests.Timeout: The API could not be reached, after MAX_RETRIES retries.
+    - CircuitOpenError: The last calls to the host all failed, so it is not called.
+    - gans_ratelimit.QuotaExceededError: The monthly quota of the host is used up.
+    """
+    requests = importlib.import_module('requests')
+    host = host_of(url)
+    kwargs.setdefault('timeout', REQUEST_TIMEOUT_SECONDS)
+    for attempt in range(MAX_RETRIES + 1):
+        # Fail at once while the host is known to be down, then wait for the rate limit, and count the call in the monthly usage.
+        circuit_breaker.before_call(host)
+        rate_limiter.acquire(host)
+        try:
+            response = session.get(url, **kwargs)
+        except (requests.ConnectionError, requests.Timeout):
+            circuit_breaker.record(host, success=False)
+            if attempt == MAX_RETRIES:
+                raise
+            time.sleep(backoff_seconds(attempt))
+            continue
+
+        if response.status_code == 429:
+            # Too many requests: the host works, but stop all the calls to it for as long as the server asks.
+            rate_limiter.pause(host, retry_after_seconds(response, default=backoff_seconds(attempt)))
+        elif response.status_code >= 500:
+            # Server error: wait a bit longer after every failed try.
+            circuit_breaker.record(host, success=False)
+            if attempt < MAX_RETRIES:
+                time.sleep(backoff_seconds(attempt))
+        else:
+            # Other errors (e.g. 404 for an unknown city) would fail again: raise them at once.
+            circuit_breaker.record(host, success=True)
+            response.raise_for_status()
+            return response
+
+    # Still failing after every retry.
+    response.raise_for_status()
+
+
+def arrival_windows(start_date, end_date=None, hours=12):
+    """
+    Splits the days from 'start_date' to 'end_date' (both included) into time windows of the flights endpoint.
+
+    Parameters:
+    - start_date (date): First day.
+    - end_date (date): Last day. Defaults to 'start_date'.
+    - hours (int): Length of a window. The API accepts at most 12 hours.
+
+    Returns:
+    - list: (start, end) datetimes, e.g. 00:00-11:59 and 12:00-23:59 for every day.
+    """
+    end_date = end_date or start_date
+    windows = []
+    day = start_date
+    while day <= end_date:
+        for hour in range(0, 24, hours):
+            start = datetime(day.year, day.month, day.day, hour)
+            windows.append((start, start + timedelta(hours=hours, minutes=-1)))
+        day += timedelta(days=1)
+    return windows
+
+
+def fetch_arrivals_window(get, base_url, api_key, icao, start, end):
+    """
+    Fetches the arrivals of one airport in one time window, splitting the window when the API returns too many arrivals.
+
+    Parameters:
+    - get (function): Sends a GET request, called as get(url, headers=..., params=...), and returns the successful response.
+    - base_url (str): URL of the AeroDataBox API, e.g. 'https://aerodatabox.p.rapidapi.com'.
+    - api_key (str): RapidAPI key.
+    - icao (str): ICAO code of the airport.
+    - start (datetime): Start of the window, local time of the airport.
+    - end (datetime): End of the window, local time of the airport.
+
+    Returns:
+    - list: The arrivals, as JSON records.
+    """
+    url = f"{base_url}/flights/airports/icao/{icao}/{start:%Y-%m-%dT%H:%M}/{end:%Y-%m-%dT%H:%M}"
+    querystring = {"withLeg": "true", "direction": "Arrival", "withCancelled": "false", "withCodeshared": "true"}
+    headers = {"X-RapidAPI-Key": api_key,
+               "X-RapidAPI-Host": "aerodatabox.p.rapidapi.com"}
+    # The API answers '204 No Content' when there are no flights.
+    response = get(url, headers=headers, params=querystring)
+    arrivals = response.json()['arrivals'] if response.status_code != 204 else []
+
+    # A full response may be missing flights: fetch both halves of the window separately.
+    if len(arrivals) >= ARRIVALS_PER_REQUEST_CAP and end - start > MIN_ARRIVALS_WINDOW:
+        middle = (start + (end - start) // 2).replace(second=0, microsecond=0)
+        return (fetch_arrivals_window(get, base_url, api_key, icao, start, middle)
+                + fetch_arrivals_window(get, base_url, api_key, icao, middle + timedelta(minutes=1), end))
+    return arrivals
@@ -0,0 +1,223 @@
+"""
+Parquet landing zone of the GANS pipeline: every fetch also writes its rows, as returned by the APIs
+and parsed into the declared schema, to compressed Parquet files before they are loaded into MySQL.
+
+The files are partitioned by source (the API), table, date and city or airport:
+
+    <root>/<source>/<table>/date=<YYYY-MM-DD>/<unit column>=<value>/part-<time>-<id>.parquet
+    e.g. landing/openweathermap/cities_weather/date=2023-03-07/city_id=1/part-20230307T080000-1a2b3c4d.parquet
+
+so a day, or a single city or airport of a day, can be read back without calling the APIs again:
+to replay a load into MySQL, to backfill a new table, or for analytical reads that would be slow on
+the database. The root is a local directory or an S3 (or S3-compatible, e.g. MinIO) URI such as
+'s3://bucket/landing?endpoint_override=localhost:9000', handled by pyarrow.fs.
+
+Every fetch writes small files; 'compact' merges the small files of a partition landed with the same tag into one,
+which keeps the tag.
+
+pyarrow is imported only when the landing zone is used, so the Lambda handler can import this module
+without paying for it.
+"""
+import importlib
+import os
+import uuid
+from datetime import datetime, timezone
+
+import gans_schema
+
+# API each table is fetched from: the first level of the layout.
+SOURCES = {
+    'cities_info': 'wikipedia',
+    'cities_weather': 'openweathermap',
+    'cities_airports': 'aerodatabox',
+    'cities_arrivals': 'aerodatabox'
+}
+
+# Column of the city or airport a row belongs to: the last level of the layout.
+UNIT_COLUMNS = {
+    'cities_info': 'city_id',
+    'cities_weather': 'city_id',
+    'cities_airports': 'airport_icao',
+    'cities_arrivals': 'arrival_airport_icao'
+}
+
+# Parquet compression codec: zstd is about as fast as snappy and gives smaller files.
+COMPRESSION = 'zstd'
+
+# Files smaller than this are merged by 'compact'.
+SMALL_FILE_BYTES = 16 * 1024 * 1024
+
+
+def file_name(tag=None):
+    """Returns the name of a new file: 'part-<time>-<tag>-<id>.parquet', or 'part-<time>-<id>.parquet' without a tag."""
+    return f'part-{datetime.now(timezone.utc).strftime("%Y%m%dT%H%M%S")}-{tag + "-" if tag else ""}{uuid.uuid4().hex[:8]}.parquet'
+
+
+def file_tag(path):
+    """Returns the tag in the name of a landed file, or None if it was landed without one."""
+    parts = path.rsplit('/', 1)[-1][:-len('.parquet')].split('-', 2)
+    return parts[2].rsplit('-', 1)[0] if len(parts) == 3 and '-' in parts[2] else None
+
+
+class LandingZone:
+    """
+    Directory of Parquet files, local or on S3, where the rows of every fetch are landed.
+
+    A landing zone created without a URI is disabled: 'land' does nothing, so the fetch functions can always call it.
+    """
+    def __init__(self, uri=None):
+        self.uri = uri
+        self.enabled = bool(uri)
+        # Opened on first use, from the URI.
+        self.filesystem = None
+        self.root = None
+
+    def open(self):
+        """Returns the filesystem and the root path of the landing zone, opening them on first use."""
+        if self.filesystem is None:
+            fs = importlib.import_module('pyarrow.fs')
+            if '://' in self.uri:
+                self.filesystem, self.root = fs.FileSystem.from_uri(self.uri)
+            else:
+                # A local directory, possibly relative to the working directory.
+                self.filesystem, self.root = fs.LocalFileSystem(), os.path.abspath(self.uri)
+        return self.filesystem, self.root
+
+    def partition(self, table_name, day=None, unit=None):
+        """
+        Returns the path of a partition: a table, a table on one day, or one city or airport of that day.
+
+        Parameters:
+        - table_name (str): Name of the table, e.g. 'cities_weather'.
+        - day (date): Day of the fetch. All days by default.
+        - unit: City id or airport ICAO code. All cities or airports of the day by default.
+        """
+        filesystem, root = self.open()
+        path = f'{root.rstrip("/")}/{SOURCES[table_name]}/{table_name}'
+        if day is not None:
+            path += f'/date={day.isoformat()}'
+            if unit is not None:
+                path += f'/{UNIT_COLUMNS[table_name]}={unit}'
+        return path
+
+    def land(self, table_name, rows, day=None, tag=None):
+        """
+        Writes the rows of one fetch to the landing zone, one compressed Parquet file per city or airport.
+
+        Parameters:
+        - table_name (str): Name of the table the rows belong to, e.g. 'cities_arrivals'.
+        - rows (DataFrame or list): DataFrame with the columns of the table, or list of dictionaries (as built by the Lambda handler).
+        - day (date): Day of the fetch, the date partition. Today (in UTC) by default.
+        - tag (str): Short id written in the file names, e.g. of the unit of a run, to find the files of that fetch with 'files'.
+
+        Returns:
+        - list: Paths of the files written. Empty when the landing zone is disabled or there are no rows.
+        """
+        if not self.enabled or len(rows) == 0:
+            return []
+        pa = importlib.import_module('pyarrow')
+        pc = importlib.import_module('pyarrow.compute')
+        pq = importlib.import_module('pyarrow.parquet')
+        filesystem, root = self.open()
+
+        # Convert the rows to an Arrow table with the declared types of the table.
+        schema = gans_schema.arrow_schema(table_name)
+        if isinstance(rows, list):
+            table = pa.Table.from_pylist(rows, schema=schema)
+        else:
+            table = pa.Table.from_pandas(rows[schema.names], schema=schema, preserve_index=False).replace_schema_metadata(None)
+
+        # One file per city or airport, named after the time of the fetch and a random id, so concurrent fetches never write the same file.
+        day = day or datetime.now(timezone.utc).date()
+        name = file_name(tag)
+        units = table.column(UNIT_COLUMNS[table_name])
+        paths = []
+        for unit in pc.unique(units).to_pylist():
+            directory = self.partition(table_name, day, unit)
+            filesystem.create_dir(directory, recursive=True)
+            pq.write_table(table.filter(pc.equal(units, unit)), f'{directory}/{name}', filesystem=filesystem, compression=COMPRESSION)
+            paths.append(f'{directory}/{name}')
+        return paths
+
+    def files(self, table_name, day=None, unit=None, tag=None):
+        """
+        Returns the FileInfo of every Parquet file of a partition, sorted by path (and so by time within a city or airport).
+        With a 'tag', only the files landed with that tag (or merged from files with that tag by 'compact').
+        """
+        fs = importlib.import_module('pyarrow.fs')
+        filesystem, root = self.open()
+        selector = fs.FileSelector(self.partition(table_name, day, unit), recursive=True, allow_not_found=True)
+        return sorted([info for info in filesystem.get_file_info(selector)
+                       if info.path.endswith('.parquet') and (tag is None or file_tag(info.path) == tag)], key=lambda info: info.path)
+
+    def read_file(self, table_name, path):
+        """Reads one Parquet file of a table into an Arrow table with the declared types."""
+        pq = importlib.import_module('pyarrow.parquet')
+        filesystem, root = self.open()
+        # The partition directories are not read as columns: every file already holds all the columns of the table.
+        return pq.read_table(path, filesystem=filesystem, schema=gans_schema.arrow_schema(table_name), partitioning=None)
+
+    def iter_partition(self, table_name, day=None, unit=None):
+        """
+        Yields the rows of a partition one file at a time, e.g. to load a large partition into MySQL with 'write_chunks'.
+
+        Yields:
+        - DataFrame: The rows of one file, with the declared types of the table.
+        """
+        for info in self.files(table_name, day, unit):
+            yield gans_schema.enforce(self.read_file(table_name, info.path).to_pandas(), table_name)
+
+    def read(self, table_name, day=None, unit=None):
+        """
+        Reads a partition of the landing zone into one DataFrame, without any API call.
+
+        Parameters:
+        - table_name (str): Name of the table, e.g. 'cities_weather'.
+        - day (date): Day of the fetch. All days by default.
+        - unit: City id or airport ICAO code. All cities or airports by default.
+
+        Returns:
+        - DataFrame: The landed rows, with the columns and types of the table. Empty if nothing was landed.
+        """
+        pa = importlib.import_module('pyarrow')
+        tables = [self.read_file(table_name, info.path) for info in self.files(table_name, day, unit)]
+        table = pa.concat_tables(tables) if tables else gans_schema.arrow_schema(table_name).empty_table()
+        return gans_schema.enforce(table.to_pandas(), table_name)
+
+    def compact(self, table_name, day, small_file_bytes=SMALL_FILE_BYTES):
+        """
+        Merges the small files of every city or airport of a day into one file per tag, named with that tag, so that
+        'files' still finds the rows of a tagged fetch (e.g. replayed by the Lambda handler) after the compaction.
+
+        The merged file is written before the small files are deleted, so an interrupted compaction may leave rows
+        twice in the partition, but never loses any (loading into MySQL upserts them on their natural key).
+
+        Parameters:
+        - table_name (str): Name of the table.
+        - day (date): Day to compact.
+        - small_file_bytes (int): Only files smaller than this are merged.
+
+        Returns:
+        - int: Number of files the partition has fewer than before.
+        """
+        pa = importlib.import_module('pyarrow')
+        pq = importlib.import_module('pyarrow.parquet')
+        filesystem, root = self.open()
+
+        # Group the small files by city or airport directory and by tag.
+        groups = {}
+        for info in self.files(table_name, day):
+            if info.size < small_file_bytes:
+                groups.setdefault((info.path.rsplit('/', 1)[0], file_tag(info.path)), []).append(info.path)
+
+        removed = 0
+        for (directory, tag), paths in groups.items():
+            if len(paths) < 2:
+                continue
+            table = pa.concat_tables([self.read_file(table_name, path) for path in paths])
+            name = file_name(tag)
+            pq.write_table(table, f'{directory}/{name}', filesystem=filesystem, compression=COMPRESSION)
+            for path in paths:
+                filesystem.delete_file(path)
+            removed += len(paths) - 1
+        return removed
@@ -0,0 +1,178 @@
+"""
+Run ledger of the GANS pipeline: records, for every unit of work of a run, whether it is still pending, was
+fetched, or was written to the database, so that a run that died half-way (a Lambda timeout, a lost database
+connection) can be started again and only process the units that were not written yet.
+
+A unit is identified by the run it belongs to and by (stage, unit, window):
+
+    run_id         stage       unit       window
+    '2023-03-08'   'weather'   'Berlin'   ''
+    '2023-03-08'   'arrivals'  'EDDB'     '2023-03-08T12:00'
+
+The run id names the work being done, e.g. the day loaded by the Lambda handler or the days of a backfill, so
+invoking the same run again resumes it. Two stores are available, with the same methods:
+- FileLedger: a local JSON lines file, e.g. for backfills run from the notebook;
+- TableLedger: a small 'pipeline_ledger' table in the pipeline's database, for the Lambda handler, whose local
+  disk doesn't outlive the container.
+
+Units are marked written after the transaction writing their rows was committed, so a crash in between writes
+them again in the next run. The tables are written with upserts on their natural key, so this never duplicates rows.
+
+This module imports sqlalchemy only inside TableLedger, so the Lambda handler can import it without paying for it.
+"""
+import importlib
+import json
+import os
+import threading
+from datetime import datetime, timezone
+
+# Statuses of a unit, in the order it goes through them.
+PENDING = 'pending'
+FETCHED = 'fetched'
+WRITTEN = 'written'
+
+# Name of the table of TableLedger.
+LEDGER_TABLE = 'pipeline_ledger'
+
+
+class Ledger:
+    """
+    Methods shared by the ledger stores, built on their 'statuses' and 'mark' methods.
+    """
+    def pending(self, run_id, units, resume=True):
+        """
+        Registers the units of a run and returns those still to be processed.
+
+        Parameters:
+        - run_id (str): Id of the run.
+        - units (list): (stage, unit, window) tuples of all the units of the run.
+        - resume (bool): Skip the units already written by an earlier invocation of the run. False processes all of them again.
+
+        Returns:
+        - list: The units not written yet (all of them when 'resume' is False), in the order of 'units'.
+        """
+        statuses = self.statuses(run_id)
+        new_units = [unit for unit in dict.fromkeys(units) if unit not in statuses]
+        if new_units:
+            self.mark(run_id, new_units, PENDING)
+        if not resume:
+            return list(units)
+        return [unit for unit in units if statuses.get(unit) != WRITTEN]
+
+
+class FileLedger(Ledger):
+    """
+    Ledger kept in a local JSON lines file: every change of status is appended as one line, and the last line of a unit wins.
+    """
+    def __init__(self, path):
+        self.path = path
+        self.lock = threading.Lock()
+
+    def statuses(self, run_id):
+        """
+        Returns the current status of every unit of a run.
+
+        Returns:
+        - dict: Status of every (stage, unit, window) registered for the run.
+        """
+        statuses = {}
+        with self.lock:
+            if not os.path.exists(self.path):
+                return statuses
+            with open(self.path, 'r', encoding='utf-8') as file:
+                for line in file:
+                    # A line cut off by a crash while it was appended is ignored.
+                    try:
+                        record = json.loads(line)
+                    except ValueError:
+                        continue
+                    if record['run_id'] == run_id:
+                        statuses[(record['stage'], record['unit'], record['window'])] = record['status']
+        return statuses
+
+    def mark(self, run_id, units, status):
+        """
+        Records the new status of units of a run.
+
+        Parameters:
+        - run_id (str): Id of the run.
+        - units (list): (stage, unit, window) tuples.
+        - status (str): PENDING, FETCHED or WRITTEN.
+        """
+        if not units:
+            return
+        updated_at = datetime.now(timezone.utc).isoformat()
+        lines = [json.dumps({'run_id': run_id, 'stage': stage, 'unit': unit, 'window': window, 'status': status, 'updated_at': updated_at}) + '\n'
+                 for stage, unit, window in units]
+        with self.lock:
+            with open(self.path, 'a', encoding='utf-8') as file:
+                file.writelines(lines)
+                file.flush()
+                os.fsync(file.fileno())
+
+
+class TableLedger(Ledger):
+    """
+    Ledger kept in the LEDGER_TABLE table of a database, created on first use.
+    """
+    def __init__(self, engine):
+        self.engine = engine
+        self.table = None
+        self.lock = threading.Lock()
+
+    def open(self):
+        """Returns the SQLAlchemy Table of the ledger, creating it in the database on first use."""
+        with self.lock:
+            if self.table is None:
+                sqlalchemy = importlib.import_module('sqlalchemy')
+                table = sqlalchemy.Table(LEDGER_TABLE, sqlalchemy.MetaData(),
+                                         sqlalchemy.Column('run_id', sqlalchemy.String(64), nullable=False),
+                                         sqlalchemy.Column('stage', sqlalchemy.String(16), nullable=False),
+                                         sqlalchemy.Column('unit', sqlalchemy.String(64), nullable=False),
+                                         # 'window' is a reserved word in MySQL 8.
+                                         sqlalchemy.Column('time_window', sqlalchemy.String(32), nullable=False),
+                                         sqlalchemy.Column('status', sqlalchemy.String(8), nullable=False),
+                                         sqlalchemy.Column('updated_at', sqlalchemy.DateTime(), nullable=False),
+                                         sqlalchemy.UniqueConstraint('run_id', 'stage', 'unit', 'time_window', name=f'uq_{LEDGER_TABLE}_unit'))
+                with self.engine.begin() as connection:
+                    table.create(connection, checkfirst=True)
+                self.table = table
+        return self.table
+
+    def statuses(self, run_id):
+        """
+        Returns the current status of every unit of a run.
+
+        Returns:
+        - dict: Status of every (stage, unit, window) registered for the run.
+        """
+        sqlalchemy = importlib.import_module('sqlalchemy')
+        table = self.open()
+        query = sqlalchemy.select(table.c.stage, table.c.unit, table.c.time_window, table.c.status).where(table.c.run_id == run_id)
+        with self.engine.connect() as connection:
+            return {(stage, unit, window): status for stage, unit, window, status in connection.execute(query)}
+
+    def mark(self, run_id, units, status):
+        """
+        Records the new status of units of a run, in one transaction.
+
+        Parameters:
+        - run_id (str): Id of the run.
+        - units (list): (stage, unit, window) tuples.
+        - status (str): PENDING, FETCHED or WRITTEN.
+        """
+        if not units:
+            return
+        sqlalchemy = importlib.import_module('sqlalchemy')
+        table = self.open()
+        units = list(dict.fromkeys(units))
+        # Replace the rows of the units, in the same way on every database.
+        key = sqlalchemy.and_(table.c.run_id == sqlalchemy.bindparam('key_run_id'), table.c.stage == sqlalchemy.bindparam('key_stage'),
+                              table.c.unit == sqlalchemy.bindparam('key_unit'), table.c.time_window == sqlalchemy.bindparam('key_window'))
+        updated_at = datetime.now(timezone.utc).replace(tzinfo=None, microsecond=0)
+        with self.engine.begin() as connection:
+            connection.execute(table.delete().where(key),
+                               [{'key_run_id': run_id, 'key_stage': stage, 'key_unit': unit, 'key_window': window} for stage, unit, window in units])
+            connection.execute(table.insert(),
+                               [{'run_id': run_id, 'stage': stage, 'unit': unit, 'time_window': window, 'status': status, 'updated_at': updated_at}
+                                for stage, unit, window in units])
@@ -0,0 +1,397 @@
+"""
+Rate limits and monthly quotas of the APIs called by the GANS pipeline, shared by the notebook and lambda_function.py.
+
+Every call to an API host goes through a HostRateLimiter, which:
+- waits for a token of the host's token bucket, so the calls never exceed the allowed rate (the bucket size
+  allows short bursts), and can pause the host after a '429 Too Many Requests';
+- counts the call in the monthly usage of the host, and refuses it with QuotaExceededError once the monthly
+  quota is reached.
+
+When several processes call the same host, e.g. the shard workers of a sharded Lambda run, each one keeping its own
+token bucket would allow the rate once per process. With a TableRates store, every process takes its calls from a
+SharedTokenBucket kept in an 'api_rate' table of the pipeline's database instead, so together they keep to the rate.
+
+The monthly usage is kept in a store, with the same methods:
+- FileUsage: a local JSON file ('api_usage.json'), for the notebook;
+- TableUsage: a small 'api_usage' table in the pipeline's database, for the Lambda handler, whose local disk
+  doesn't outlive the container and whose invocations may run at the same time.
+
+A store hands out calls in leases: the limiter claims 'lease_calls' calls of a host at once and counts them down
+locally, so the table is not written on every call, and 'release' gives back the calls claimed but not made.
+'reserve' claims the calls a run expects to make up front, e.g. before its writes start.
+
+This module imports sqlalchemy only inside TableUsage, so the Lambda handler can import it without paying for it.
+"""
+import importlib
+import json
+import os
+import threading
+import time
+from datetime import datetime, timezone
+
+# Names of the tables of TableUsage and TableRates.
+USAGE_TABLE = 'api_usage'
+RATE_TABLE = 'api_rate'
+
+# Allowed rate of every API host: (requests per second, number of requests allowed in a burst).
+RATE_LIMITS = {
+    'api.openweathermap.org': (1.0, 60),
+    'aerodatabox.p.rapidapi.com': (1.0, 1)
+}
+
+# Number of calls allowed per calendar month by the plan of every API host. Adjust to the plans in use.
+MONTHLY_QUOTAS = {
+    'api.openweathermap.org': 1000000,
+    'aerodatabox.p.rapidapi.com': 600
+}
+
+
+class QuotaExceededError(Exception):
+    """Raised instead of calling an API whose monthly quota is already used up."""
+
+
+def current_month():
+    """Returns the month in which the calls are counted, e.g. '2023-03' (UTC)."""
+    return datetime.now(timezone.utc).strftime('%Y-%m')
+
+
+class TokenBucket:
+    """
+    Thread-safe token bucket: 'rate' tokens are added per second, up to 'capacity'. Every request takes one token.
+    """
+    def __init__(self, rate, capacity):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated_at = time.monotonic()
+        self.paused_until = 0.0
+        self.lock = threading.Lock()
+
+    def acquire(self):
+        """Blocks until a token is available and takes it."""
+        while True:
+            with self.lock:
+                now = time.monotonic()
+                # Add the tokens earned since the last update, without going over the capacity.
+                self.tokens = min(self.capacity, self.tokens + (now - self.updated_at) * self.rate)
+                self.updated_at = now
+                if now >= self.paused_until and self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                # Time until the pause ends and a full token is available.
+                wait = max(self.paused_until - now, (1 - self.tokens) / self.rate)
+            time.sleep(wait)
+
+    def pause(self, seconds):
+        """Stops giving tokens for 'seconds', e.g. after the server asked to retry later, and empties the bucket."""
+        with self.lock:
+            self.paused_until = max(self.paused_until, time.monotonic() + seconds)
+            self.tokens = 0
+
+
+class TableRates:
+    """
+    Token buckets of the API hosts kept in the RATE_TABLE table of a database, created on first use, and shared by every process using it.
+
+    A bucket is kept as the theoretical time of the next call of its host at the allowed rate (the 'generic cell rate
+    algorithm'): a call may start 'burst_seconds' before that time, so that up to capacity calls can start at once,
+    and every call moves it one interval later. A call is then one short transaction, without polling.
+    """
+    def __init__(self, engine):
+        self.engine = engine
+        self.table = None
+        self.lock = threading.Lock()
+
+    def open(self):
+        """Returns the SQLAlchemy Table of the buckets, creating it in the database on first use."""
+        with self.lock:
+            if self.table is None:
+                sqlalchemy = importlib.import_module('sqlalchemy')
+                table = sqlalchemy.Table(RATE_TABLE, sqlalchemy.MetaData(),
+                                         sqlalchemy.Column('host', sqlalchemy.String(64), nullable=False),
+                                         # Seconds since the epoch, in double precision.
+                                         sqlalchemy.Column('next_call_at', sqlalchemy.Float(precision=53), nullable=False),
+                                         sqlalchemy.UniqueConstraint('host', name=f'uq_{RATE_TABLE}_host'))
+                try:
+                    with self.engine.begin() as connection:
+                        table.create(connection, checkfirst=True)
+                except sqlalchemy.exc.DatabaseError:
+                    # Another process, e.g. another shard worker, created the table at the same time.
+                    if not sqlalchemy.inspect(self.engine).has_table(table.name):
+                        raise
+                self.table = table
+        return self.table
+
+    def update(self, host, advance):
+        """
+        Moves the next call time of 'host' in one transaction, with the row locked against the other processes.
+
+        Parameters:
+        - host (str): Host of the bucket.
+        - advance (function): Called with the stored next call time (None for a new host); returns the new one and the result.
+
+        Returns:
+        - The result returned by 'advance'.
+        """
+        sqlalchemy = importlib.import_module('sqlalchemy')
+        table = self.open()
+        for attempt in range(2):
+            try:
+                with self.engine.begin() as connection:
+                    # Lock the row first: an UPDATE locks it on every database, where SQLite ignores 'SELECT ... FOR UPDATE'.
+                    connection.execute(table.update().where(table.c.host == host).values(next_call_at=table.c.next_call_at))
+                    next_call_at = connection.execute(sqlalchemy.select(table.c.next_call_at).where(table.c.host == host)).scalar()
+                    new_next_call_at, result = advance(next_call_at)
+                    if next_call_at is None:
+                        connection.execute(table.insert().values(host=host, next_call_at=new_next_call_at))
+                    else:
+                        connection.execute(table.update().where(table.c.host == host).values(next_call_at=new_next_call_at))
+                    return result
+            except sqlalchemy.exc.IntegrityError:
+                # Another process inserted the row of the host first: update its row.
+                if attempt:
+                    raise
+
+    def reserve(self, host, interval, burst_seconds):
+        """
+        Reserves the next call allowed to 'host'.
+
+        Returns:
+        - float: Time (seconds since the epoch) at which the call may start.
+        """
+        def advance(next_call_at):
+            now = time.time()
+            next_call_at = max(next_call_at or now, now)
+            return next_call_at + interval, max(now, next_call_at - burst_seconds)
+        return self.update(host, advance)
+
+    def pause(self, host, seconds, burst_seconds):
+        """Lets no call to 'host' start in the next 'seconds', e.g. after the server asked to retry later."""
+        def advance(next_call_at):
+            return max(next_call_at or 0.0, time.time() + seconds + burst_seconds), None
+        self.update(host, advance)
+
+
+class SharedTokenBucket:
+    """
+    Token bucket with the methods of TokenBucket, kept in a TableRates store and shared by every process using it.
+    """
+    def __init__(self, rates, host, rate, capacity):
+        self.rates = rates
+        self.host = host
+        self.interval = 1 / rate
+        self.burst_seconds = (capacity - 1) / rate
+
+    def acquire(self):
+        """Blocks until the reserved call time of the host and returns."""
+        call_at = self.rates.reserve(self.host, self.interval, self.burst_seconds)
+        if call_at > time.time():
+            time.sleep(call_at - time.time())
+
+    def pause(self, seconds):
+        """Stops the calls of every process to the host for 'seconds'."""
+        self.rates.pause(self.host, seconds, self.burst_seconds)
+
+
+class FileUsage:
+    """
+    Monthly usage kept in a local JSON file: {host: {month: calls}}.
+    """
+    def __init__(self, path):
+        self.path = path
+        self.usage = None
+        self.lock = threading.Lock()
+
+    def load(self):
+        # Read the saved counters the first time they are needed.
+        if self.usage is None:
+            if os.path.exists(self.path):
+                with open(self.path, 'r') as file:
+                    self.usage = json.load(file)
+            else:
+                self.usage = {}
+        return self.usage
+
+    def save(self):
+        # Save the counters through a temporary file, so a crash never leaves a half-written file.
+        with open(self.path + '.tmp', 'w') as file:
+            json.dump(self.usage, file)
+        os.replace(self.path + '.tmp', self.path)
+
+    def claim(self, host, month, calls, quota=None):
+        """
+        Counts up to 'calls' calls to 'host' in 'month', without going over 'quota'.
+
+        Returns:
+        - int: Number of calls granted, 0 when the quota is used up.
+        """
+        with self.lock:
+            usage = self.load().setdefault(host, {})
+            granted = calls if quota is None else max(0, min(calls, quota - usage.get(month, 0)))
+            if granted:
+                usage[month] = usage.get(month, 0) + granted
+                self.save()
+            return granted
+
+    def release(self, host, month, calls):
+        """Gives back calls claimed but not made."""
+        with self.lock:
+            usage = self.load().setdefault(host, {})
+            usage[month] = max(0, usage.get(month, 0) - calls)
+            self.save()
+
+    def calls(self, host, month):
+        """Returns the number of calls counted for 'host' in 'month'."""
+        with self.lock:
+            return self.load().get(host, {}).get(month, 0)
+
+
+class TableUsage:
+    """
+    Monthly usage kept in the USAGE_TABLE table of a database, created on first use, and shared by every process using it.
+    """
+    def __init__(self, engine):
+        self.engine = engine
+        self.table = None
+        self.lock = threading.Lock()
+
+    def open(self):
+        """Returns the SQLAlchemy Table of the usage, creating it in the database on first use."""
+        with self.lock:
+            if self.table is None:
+                sqlalchemy = importlib.import_module('sqlalchemy')
+                table = sqlalchemy.Table(USAGE_TABLE, sqlalchemy.MetaData(),
+                                         sqlalchemy.Column('host', sqlalchemy.String(64), nullable=False),
+                                         sqlalchemy.Column('month', sqlalchemy.CHAR(7), nullable=False),
+                                         sqlalchemy.Column('calls', sqlalchemy.Integer(), nullable=False),
+                                         sqlalchemy.UniqueConstraint('host', 'month', name=f'uq_{USAGE_TABLE}_host_month'))
+                try:
+                    with self.engine.begin() as connection:
+                        table.create(connection, checkfirst=True)
+                except sqlalchemy.exc.DatabaseError:
+                    # Another process, e.g. another shard worker, created the table at the same time.
+                    if not sqlalchemy.inspect(self.engine).has_table(table.name):
+                        raise
+                self.table = table
+        return self.table
+
+    def claim(self, host, month, calls, quota=None):
+        """
+        Counts up to 'calls' calls to 'host' in 'month', without going over 'quota', in one transaction.
+
+        Returns:
+        - int: Number of calls granted, 0 when the quota is used up.
+        """
+        sqlalchemy = importlib.import_module('sqlalchemy')
+        table = self.open()
+        key = sqlalchemy.and_(table.c.host == host, table.c.month == month)
+        for attempt in range(2):
+            try:
+                with self.engine.begin() as connection:
+                    # Lock the row of the month first, so concurrent invocations never grant the same calls twice. An
+                    # UPDATE locks it on every database, where SQLite ignores 'SELECT ... FOR UPDATE'.
+                    connection.execute(table.update().where(key).values(calls=table.c.calls))
+                    used = connection.execute(sqlalchemy.select(table.c.calls).where(key)).scalar()
+                    granted = calls if quota is None else max(0, min(calls, quota - (used or 0)))
+                    if used is None:
+                        connection.execute(table.insert().values(host=host, month=month, calls=granted))
+                    elif granted:
+                        connection.execute(table.update().where(key).values(calls=table.c.calls + granted))
+                    return granted
+            except sqlalchemy.exc.IntegrityError:
+                # Another process inserted the row of the month first: claim again from its row.
+                if attempt:
+                    raise
+
+    def release(self, host, month, calls):
+        """Gives back calls claimed but not made."""
+        sqlalchemy = importlib.import_module('sqlalchemy')
+        table = self.open()
+        with self.engine.begin() as connection:
+            connection.execute(table.update().where(table.c.host == host, table.c.month == month)
+                               .values(calls=sqlalchemy.case((table.c.calls > calls, table.c.calls - calls), else_=0)))
+
+    def calls(self, host, month):
+        """Returns the number of calls counted for 'host' in 'month'."""
+        sqlalchemy = importlib.import_module('sqlalchemy')
+        table = self.open()
+        with self.engine.connect() as connection:
+            return connection.execute(sqlalchemy.select(table.c.calls).where(table.c.host == host, table.c.month == month)).scalar() or 0
+
+
+class HostRateLimiter:
+    """
+    Keeps one token bucket and the monthly call count of every API host.
+
+    Parameters:
+    - rate_limits (dict): (requests per second, burst size) of every host. Hosts not listed are not limited.
+    - monthly_quotas (dict): Number of calls allowed per calendar month for every host. Hosts not listed have no quota.
+    - usage (FileUsage or TableUsage): Store of the monthly usage, or None not to count the calls.
+    - lease_calls (int): Number of calls claimed from the store at once.
+    - rates (TableRates): Store of token buckets shared with other processes. By default the buckets are kept in this process.
+    """
+    def __init__(self, rate_limits, monthly_quotas, usage, lease_calls=1, rates=None):
+        if rates is None:
+            self.buckets = {host: TokenBucket(rate, capacity) for host, (rate, capacity) in rate_limits.items()}
+        else:
+            self.buckets = {host: SharedTokenBucket(rates, host, rate, capacity) for host, (rate, capacity) in rate_limits.items()}
+        self.monthly_quotas = monthly_quotas
+        self.usage = usage
+        self.lease_calls = lease_calls
+        # Calls claimed from the store and not made yet, per (host, month).
+        self.leased = {}
+        self.lock = threading.Lock()
+
+    def reserve(self, host, calls):
+        """
+        Claims 'calls' calls to 'host' from the store at once, e.g. all the calls of a run before it starts writing.
+
+        Returns:
+        - int: Number of calls granted, fewer when the quota doesn't allow them all.
+        """
+        if self.usage is None or calls <= 0:
+            return calls
+        month = current_month()
+        with self.lock:
+            granted = self.usage.claim(host, month, calls, self.monthly_quotas.get(host))
+            self.leased[(host, month)] = self.leased.get((host, month), 0) + granted
+        return granted
+
+    def count_call(self, host):
+        """Counts one call to 'host' in the current month, or raises QuotaExceededError when the quota is used up."""
+        if self.usage is None:
+            return
+        month = current_month()
+        with self.lock:
+            if not self.leased.get((host, month)):
+                self.leased[(host, month)] = self.usage.claim(host, month, self.lease_calls, self.monthly_quotas.get(host))
+            if not self.leased[(host, month)]:
+                raise QuotaExceededError(f"Monthly quota of {self.monthly_quotas[host]} calls to {host} reached")
+            self.leased[(host, month)] -= 1
+
+    def release(self):
+        """Gives back to the store the calls claimed but not made, e.g. at the end of a run."""
+        if self.usage is None:
+            return
+        with self.lock:
+            leased, self.leased = self.leased, {}
+            for (host, month), calls in leased.items():
+                if calls:
+                    self.usage.release(host, month, calls)
+
+    def calls_this_month(self, host):
+        """Returns the number of calls made to 'host' in the current month."""
+        month = current_month()
+        with self.lock:
+            return self.usage.calls(host, month) - self.leased.get((host, month), 0)
+
+    def acquire(self, host):
+        """Waits until a call to 'host' is allowed by its rate limit, then counts it."""
+        if host in self.buckets:
+            self.buckets[host].acquire()
+        self.count_call(host)
+
+    def pause(self, host, seconds):
+        """Pauses all the calls to 'host' for 'seconds'."""
+        if host in self.buckets:
+            self.buckets[host].pause(seconds)
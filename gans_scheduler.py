@@ -0,0 +1,298 @@
+"""
+In-process scheduler of the GANS pipeline: runs every source on its own cadence, instead of one 12-hour trigger
+re-running everything together.
+
+Every job has a cron-like cadence ('minute hour day-of-month month day-of-week', e.g. '0 */3 * * *' for every 3
+hours), in the Europe/Berlin timezone like the rest of the pipeline, and:
+- a random jitter of up to 'jitter_seconds' added to every run, so the calls don't all hit the APIs on the hour;
+- no overlapping runs: a job still running when it is due again is skipped, not started twice;
+- a skip-if-fresh check: when the last successful load (recorded in the state file, or returned by the job's
+  'last_loaded' function, e.g. a query on the table) is less than 'fresh_for' old, the run is skipped, so a restart
+  of the scheduler or a manual load doesn't pay for the same calls and writes again. After a failed run the job is
+  never fresh, so its next due time runs it again.
+
+A run fails when its function raises, or when it returns more failed units (the cities or airports whose fetch
+failed) than the job's 'max_failed_units': a run that loaded nothing is not a successful load.
+
+The last run and last success of every job are kept in a JSON state file (GANS_SCHEDULER_STATE), and every run,
+skip and failure is logged as one JSON line.
+
+Run as a script, it schedules the weather and arrivals stages of the Lambda handler (lambda_function.py):
+    python gans_scheduler.py            # run forever
+    python gans_scheduler.py --once     # run the jobs that are due now, then exit
+The static sources (demographics, airports) are scheduled from the notebook (section 5.4), where their fetch functions live.
+"""
+import argparse
+import json
+import os
+import random
+import threading
+import time
+from datetime import datetime, timedelta
+from zoneinfo import ZoneInfo
+
+# File where the last run and last success of every job are kept.
+STATE_FILE = os.environ.get('GANS_SCHEDULER_STATE', 'gans_scheduler_state.json')
+
+# Timezone of the cadences.
+SCHEDULER_TIMEZONE = ZoneInfo('Europe/Berlin')
+
+# Seconds between two checks of the due jobs.
+TICK_SECONDS = 30
+
+# Range of every field of a cadence, in order.
+CRON_FIELDS = [('minute', 0, 59), ('hour', 0, 23), ('day', 1, 31), ('month', 1, 12), ('weekday', 0, 6)]
+
+
+def log(event, **fields):
+    print(json.dumps({'event': event, 'time': datetime.now(SCHEDULER_TIMEZONE).isoformat(timespec='seconds'), **fields}), flush=True)
+
+
+class Cron:
+    """
+    Cadence given as a cron expression: 'minute hour day-of-month month day-of-week' (0 is Sunday).
+
+    Every field is '*', a number, a range 'a-b', a step '*/n' or 'a-b/n', or a comma-separated list of these.
+    As in cron, when both the day of the month and the day of the week are restricted, a day matching either one is due.
+    """
+    def __init__(self, expression):
+        self.expression = expression
+        fields = expression.split()
+        if len(fields) != len(CRON_FIELDS):
+            raise ValueError(f"Cron expression '{expression}' must have {len(CRON_FIELDS)} fields")
+        self.values = {}
+        for field, (name, low, high) in zip(fields, CRON_FIELDS):
+            self.values[name] = self.parse_field(field, low, high)
+        self.any_day = fields[2] == '*'
+        self.any_weekday = fields[4] == '*'
+
+    @staticmethod
+    def parse_field(field, low, high):
+        """Returns the set of values of one field, e.g. {0, 3, 6, ..., 21} for '*/3' in the hours."""
+        values = set()
+        for part in field.split(','):
+            span, _, step = part.partition('/')
+            if span == '*':
+                start, end = low, high
+            elif '-' in span:
+                start, end = map(int, span.split('-'))
+            else:
+                start = end = int(span)
+            if not low <= start <= end <= high:
+                raise ValueError(f"Cron field '{field}' is out of the range {low}-{high}")
+            values.update(range(start, end + 1, int(step) if step else 1))
+        return values
+
+    def day_matches(self, moment):
+        day = moment.day in self.values['day']
+        # Python counts the weekdays from Monday = 0, cron from Sunday = 0.
+        weekday = (moment.weekday() + 1) % 7 in self.values['weekday']
+        if self.any_day or self.any_weekday:
+            return day and weekday
+        return day or weekday
+
+    def next_after(self, moment):
+        """
+        Returns the first due time after 'moment'.
+
+        Parameters:
+        - moment (datetime): Naive wall time in the timezone of the scheduler.
+
+        Returns:
+        - datetime: The next minute matching the expression.
+        """
+        moment = moment.replace(second=0, microsecond=0) + timedelta(minutes=1)
+        # Skip whole months, days and hours that don't match, then minute by minute.
+        for _ in range(366 * 24 * 60):
+            if moment.month not in self.values['month']:
+                moment = (moment.replace(day=1, hour=0, minute=0) + timedelta(days=32)).replace(day=1)
+            elif not self.day_matches(moment):
+                moment = moment.replace(hour=0, minute=0) + timedelta(days=1)
+            elif moment.hour not in self.values['hour']:
+                moment = moment.replace(minute=0) + timedelta(hours=1)
+            elif moment.minute not in self.values['minute']:
+                moment += timedelta(minutes=1)
+            else:
+                return moment
+        raise ValueError(f"Cron expression '{self.expression}' never matches")
+
+
+class Job:
+    """
+    A source loaded on its own cadence.
+
+    Parameters:
+    - name (str): Name of the job, e.g. 'weather'.
+    - function (function): Loads the source. Called with the scheduled time (a naive datetime in the scheduler's timezone),
+      returns the list of the units that failed (e.g. the failures recorded during the load), or None.
+    - cadence (str): Cron expression of the runs.
+    - jitter_seconds (float): Maximum random delay added to every run.
+    - fresh_for (timedelta): A run is skipped while the last successful load is younger than this. None never skips.
+    - last_loaded (function): Returns the time (timezone-aware) of the last successful load, e.g. from the table,
+      or None. By default the last success recorded in the state file.
+    - max_failed_units (int): Number of failed units a run may return and still count as a success.
+    """
+    def __init__(self, name, function, cadence, jitter_seconds=0, fresh_for=None, last_loaded=None, max_failed_units=0):
+        self.name = name
+        self.function = function
+        self.cron = Cron(cadence)
+        self.jitter_seconds = jitter_seconds
+        self.fresh_for = fresh_for
+        self.last_loaded = last_loaded
+        self.max_failed_units = max_failed_units
+        self.lock = threading.Lock()
+        self.next_run = None
+        self.scheduled_at = None
+
+
+class Scheduler:
+    """
+    Runs jobs on their cadences, each run in its own thread, keeping their state in a JSON file.
+    """
+    def __init__(self, jobs, state_file=STATE_FILE):
+        self.jobs = {job.name: job for job in jobs}
+        self.state_file = state_file
+        self.state = None
+        self.state_lock = threading.Lock()
+        self.threads = []
+
+    def load_state(self):
+        # Read the saved state the first time it is needed.
+        if self.state is None:
+            if os.path.exists(self.state_file):
+                with open(self.state_file, 'r') as file:
+                    self.state = json.load(file)
+            else:
+                self.state = {}
+        return self.state
+
+    def update_state(self, name, **fields):
+        """Records fields of the state of a job, e.g. its last success, and saves the state file."""
+        with self.state_lock:
+            self.load_state().setdefault(name, {}).update(fields)
+            # Save the state through a temporary file, so a crash never leaves a half-written file.
+            with open(self.state_file + '.tmp', 'w') as file:
+                json.dump(self.state, file, indent=1)
+            os.replace(self.state_file + '.tmp', self.state_file)
+
+    def last_success(self, job):
+        """Returns the time of the last successful load of a job, or None, also when its last run failed."""
+        with self.state_lock:
+            state = self.load_state().get(job.name, {})
+        if state.get('last_error'):
+            return None
+        if job.last_loaded is not None:
+            return job.last_loaded()
+        return datetime.fromisoformat(state['last_success']) if state.get('last_success') else None
+
+    def schedule_next(self, job, now):
+        """Sets the next run of a job: the next due time of its cadence after 'now', plus a random jitter."""
+        job.scheduled_at = job.cron.next_after(now)
+        job.next_run = job.scheduled_at + timedelta(seconds=random.uniform(0, job.jitter_seconds))
+
+    def run_job(self, job, scheduled_at):
+        """Runs a job once, unless it is still running or its last load is still fresh."""
+        if not job.lock.acquire(blocking=False):
+            log('job_skipped', job=job.name, reason='still running')
+            return
+        try:
+            last_success = self.last_success(job)
+            if job.fresh_for is not None and last_success is not None and datetime.now(SCHEDULER_TIMEZONE) - last_success < job.fresh_for:
+                log('job_skipped', job=job.name, reason='fresh', last_success=last_success.isoformat(timespec='seconds'))
+                return
+            started = time.perf_counter()
+            started_at = datetime.now(SCHEDULER_TIMEZONE)
+            self.update_state(job.name, last_run=started_at.isoformat(timespec='seconds'))
+            try:
+                failed_units = len(job.function(scheduled_at) or [])
+            except Exception as error:
+                self.update_state(job.name, last_error=f'{type(error).__name__}: {error}')
+                log('job_failed', job=job.name, error=f'{type(error).__name__}: {error}', seconds=round(time.perf_counter() - started, 3))
+                return
+            if failed_units > job.max_failed_units:
+                self.update_state(job.name, last_error=f'{failed_units} units failed', failed_units=failed_units)
+                log('job_failed', job=job.name, error=f'{failed_units} units failed', failed_units=failed_units, seconds=round(time.perf_counter() - started, 3))
+                return
+            # The load counts from its start: data fetched during the run is at least that old.
+            self.update_state(job.name, last_success=started_at.isoformat(timespec='seconds'), last_error=None, failed_units=failed_units)
+            log('job_succeeded', job=job.name, failed_units=failed_units, seconds=round(time.perf_counter() - started, 3))
+        finally:
+            job.lock.release()
+
+    def start(self, job, scheduled_at):
+        """Starts a run of a job in its own thread, so a slow job never delays the others."""
+        thread = threading.Thread(target=self.run_job, args=(job, scheduled_at), name=f'job-{job.name}', daemon=True)
+        thread.start()
+        self.threads = [thread for thread in self.threads if thread.is_alive()] + [thread]
+
+    def run_pending(self, now=None):
+        """Starts the jobs whose next run is due, and schedules their following run."""
+        now = now or datetime.now(SCHEDULER_TIMEZONE).replace(tzinfo=None)
+        for job in self.jobs.values():
+            if job.next_run is None:
+                self.schedule_next(job, now)
+            if job.next_run <= now:
+                self.start(job, job.scheduled_at)
+                self.schedule_next(job, now)
+
+    def run_once(self, names=None):
+        """Runs the given jobs (all by default) now, skipping the fresh ones, and waits for them to finish."""
+        now = datetime.now(SCHEDULER_TIMEZONE).replace(tzinfo=None, second=0, microsecond=0)
+        for name in names or self.jobs:
+            self.start(self.jobs[name], now)
+        for thread in self.threads:
+            thread.join()
+
+    def run_forever(self, tick_seconds=TICK_SECONDS):
+        """Checks the due jobs every 'tick_seconds', until interrupted."""
+        for job in self.jobs.values():
+            log('job_scheduled', job=job.name, cadence=job.cron.expression, fresh_for_seconds=job.fresh_for.total_seconds() if job.fresh_for else None)
+        while True:
+            self.run_pending()
+            time.sleep(tick_seconds)
+
+
+def lambda_jobs():
+    """
+    Returns the jobs of the weather and arrivals stages of the Lambda handler.
+
+    Weather runs every 3 hours, each run with its own id in the run ledger (lambda_function.py), since every run loads
+    new forecasts. Arrivals run daily for tomorrow, so a second run on the same day resumes the first one.
+    Both return the units the handler skipped after their fetch failed.
+    The handler runs one invocation at a time, as on Lambda (its database pool is sized for one), so a job due
+    while the other one runs waits for it.
+    """
+    import lambda_function
+    handler_lock = threading.Lock()
+
+    def load_weather(scheduled_at):
+        with handler_lock:
+            response = lambda_function.lambda_handler({'stages': ['weather'], 'run_id': f'weather {scheduled_at:%Y-%m-%dT%H:%M}'}, None)
+        return json.loads(response['body'])['failed_units']
+
+    def load_arrivals(scheduled_at):
+        with handler_lock:
+            response = lambda_function.lambda_handler({'stages': ['arrivals']}, None)
+        return json.loads(response['body'])['failed_units']
+
+    return [Job('weather', load_weather, '0 */3 * * *', jitter_seconds=300, fresh_for=timedelta(hours=2, minutes=30)),
+            Job('arrivals', load_arrivals, '30 6 * * *', jitter_seconds=600, fresh_for=timedelta(hours=20))]
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--once', action='store_true', help='run the jobs now (skipping the fresh ones) and exit')
+    parser.add_argument('--jobs', nargs='+', choices=['weather', 'arrivals'], help='jobs to run, all by default')
+    args = parser.parse_args()
+
+    jobs = [job for job in lambda_jobs() if not args.jobs or job.name in args.jobs]
+    scheduler = Scheduler(jobs)
+    if args.once:
+        scheduler.run_once()
+    else:
+        scheduler.run_forever()
+    return 0
+
+
+if __name__ == '__main__':
+    raise SystemExit(main())
@@ -0,0 +1,431 @@
+"""
+Declared schema of the five GANS tables, and of the 'city_hour_features' table derived from them, shared by the
+notebook and lambda_function.py.
+
+Every column is declared once with its pandas dtype and its MySQL type:
+- repeated strings (countries, weather conditions, airlines, airports) are categoricals,
+- numbers use the narrowest type that holds every real value (e.g. humidity and clouds are
+  percentages: uint8 / TINYINT UNSIGNED; pressure in hPa: int16 / SMALLINT),
+- instants (forecast and arrival times, retrieval times) are tz-aware UTC timestamps in pandas and
+  DATETIME columns holding UTC in MySQL.
+
+'enforce' converts a DataFrame to the schema of its table when the frame is built, 'to_database'
+turns it into the values written to the database, 'sqlalchemy_table' creates the table with the
+declared column types and a unique index on its natural key, 'ensure_natural_key' adds that index to
+a table created without it, 'migrate_legacy_table' converts a table written by the first version of the
+notebook (raw 'to_sql' appends: TEXT keys, local times) to the declared schema, and 'arrow_schema' gives the
+types of the Parquet files of the landing zone (gans_landing.py).
+
+This module imports pandas, sqlalchemy and pyarrow only inside the functions that need them, so the Lambda
+handler can use it without paying for pandas.
+"""
+import importlib
+import re
+
+# Columns of every table, in order: (column name, pandas dtype, MySQL type).
+TABLES = {
+    'cities': [
+        ('city_id', 'int16', 'SMALLINT'),
+        ('city', 'object', 'VARCHAR(64)'),
+        ('country', 'category', 'VARCHAR(64)')
+    ],
+    'cities_info': [
+        ('city', 'object', 'VARCHAR(64)'),
+        ('country', 'category', 'VARCHAR(64)'),
+        ('latitude', 'float32', 'FLOAT'),
+        ('longitude', 'float32', 'FLOAT'),
+        ('population', 'int32', 'INT UNSIGNED'),
+        ('city_id', 'int16', 'SMALLINT')
+    ],
+    'cities_weather': [
+        ('city_id', 'int16', 'SMALLINT'),
+        ('country', 'category', 'CHAR(2)'),
+        ('forecast_time', 'datetime64[ns, UTC]', 'DATETIME'),
+        ('weather', 'category', 'VARCHAR(32)'),
+        ('temperature', 'float32', 'FLOAT'),
+        ('temperature_feels_like', 'float32', 'FLOAT'),
+        ('clouds', 'uint8', 'TINYINT UNSIGNED'),
+        ('rain', 'float32', 'FLOAT'),
+        ('snow', 'float32', 'FLOAT'),
+        ('wind_speed', 'float32', 'FLOAT'),
+        ('humidity', 'uint8', 'TINYINT UNSIGNED'),
+        ('pressure', 'int16', 'SMALLINT'),
+        ('information_retrieved_at', 'datetime64[ns, UTC]', 'DATETIME')
+    ],
+    'cities_airports': [
+        ('airport_icao', 'object', 'CHAR(4)'),
+        ('airport_name', 'object', 'VARCHAR(128)'),
+        ('country_code', 'category', 'CHAR(2)'),
+        ('latitude', 'float32', 'FLOAT'),
+        ('longitude', 'float32', 'FLOAT')
+    ],
+    'cities_arrivals': [
+        ('arrival_airport_icao', 'category', 'CHAR(4)'),
+        ('flight_number', 'object', 'VARCHAR(16)'),
+        ('airline', 'category', 'VARCHAR(128)'),
+        ('arrival_time', 'datetime64[ns, UTC]', 'DATETIME'),
+        ('departure_city', 'category', 'VARCHAR(128)'),
+        ('departure_airport_icao', 'category', 'CHAR(4)'),
+        ('data_retrived_on', 'datetime64[ns]', 'DATE')
+    ],
+    # Features of every city and hour, maintained from the five tables above. The forecast values are floats,
+    # NaN in the hours without a forecast.
+    'city_hour_features': [
+        ('city_id', 'int16', 'SMALLINT'),
+        ('feature_hour', 'datetime64[ns, UTC]', 'DATETIME'),
+        ('arrivals', 'int16', 'SMALLINT'),
+        ('weather', 'category', 'VARCHAR(32)'),
+        ('temperature', 'float32', 'FLOAT'),
+        ('temperature_feels_like', 'float32', 'FLOAT'),
+        ('clouds', 'float32', 'FLOAT'),
+        ('rain', 'float32', 'FLOAT'),
+        ('snow', 'float32', 'FLOAT'),
+        ('wind_speed', 'float32', 'FLOAT'),
+        ('humidity', 'float32', 'FLOAT'),
+        ('pressure', 'float32', 'FLOAT'),
+        ('population', 'int32', 'INT UNSIGNED'),
+        ('forecast_retrieved_at', 'datetime64[ns, UTC]', 'DATETIME')
+    ]
+}
+
+# Columns identifying a row of each table. A unique index on these columns lets the database detect rows that are already stored.
+NATURAL_KEYS = {
+    'cities': ['city_id'],
+    'cities_info': ['city_id'],
+    'cities_weather': ['city_id', 'forecast_time', 'information_retrieved_at'],
+    'cities_airports': ['airport_icao'],
+    'cities_arrivals': ['arrival_airport_icao', 'flight_number', 'arrival_time'],
+    'city_hour_features': ['city_id', 'feature_hour']
+}
+
+# Column holding the time a row was retrieved, in the tables storing several retrievals: the latest row of a key is the one retrieved last.
+RETRIEVAL_COLUMNS = {
+    'cities_weather': 'information_retrieved_at',
+    'cities_arrivals': 'data_retrived_on',
+    'city_hour_features': 'forecast_retrieved_at'
+}
+
+# Times stored as text by the first version of the notebook, with their format and time zone, by table and column.
+# The arrival times were stored in the local time of their airport, without the offset: see 'migrate_legacy_table'.
+LEGACY_TIME_FORMATS = {
+    'cities_weather': {'forecast_time': ('%Y-%m-%d %H:%M:%S', 'UTC'),
+                       'information_retrieved_at': ('%d/%m/%Y %H:%M:%S', 'Europe/Berlin')}
+}
+
+DECLARED_TYPE_PATTERN = re.compile(r'([A-Z ]+?)(?:\((\d+)\))?$')
+
+
+class LegacyTableError(Exception):
+    """Raised instead of writing to a table created by the first version of the notebook, which must be migrated first."""
+
+
+def columns(table_name):
+    """Returns the column names of a table, in order."""
+    return [column for column, dtype, sql_type in TABLES[table_name]]
+
+
+def enforce(df, table_name):
+    """
+    Converts a DataFrame to the declared schema of a table.
+
+    Parameters:
+    - df (DataFrame): Frame with (at least) the columns of the table.
+    - table_name (str): Name of the table, e.g. 'cities_weather'.
+
+    Returns:
+    - DataFrame: The columns of the table, in order, with their declared dtypes. Naive datetimes are taken as UTC.
+      A frame already matching the schema is returned unchanged.
+    """
+    pd = importlib.import_module('pandas')
+    converted = {}
+    changed = list(df.columns) != columns(table_name)
+    for column, dtype, sql_type in TABLES[table_name]:
+        series = df[column]
+        if str(series.dtype) == dtype or (dtype == 'object' and pd.api.types.is_string_dtype(series.dtype)):
+            # Already of the declared type (pandas may store text columns in its own string dtype).
+            converted[column] = series
+            continue
+        changed = True
+        if dtype.startswith('datetime64[ns, '):
+            series = pd.to_datetime(series)
+            if series.dt.tz is None:
+                series = series.dt.tz_localize('UTC')
+            series = series.dt.tz_convert(dtype[len('datetime64[ns, '):-1]).astype(dtype)
+        elif dtype.startswith('datetime64'):
+            series = pd.to_datetime(series).astype(dtype)
+        elif dtype != 'object' and dtype != 'category' and series.dtype == object:
+            # Numbers read as text, e.g. '0'.
+            series = pd.to_numeric(series).astype(dtype)
+        else:
+            series = series.astype(dtype)
+        converted[column] = series
+    if not changed:
+        # Frames built in their declared types are returned as they are, without a copy.
+        return df
+    return pd.DataFrame(converted, index=df.index)
+
+
+def empty_frame(table_name):
+    """Returns a DataFrame with no rows and the columns and declared dtypes of a table."""
+    pd = importlib.import_module('pandas')
+    return enforce(pd.DataFrame({column: [] for column in columns(table_name)}), table_name)
+
+
+def to_database(df):
+    """
+    Returns a copy of a DataFrame ready to be written: tz-aware timestamps become naive UTC, as stored in DATETIME columns.
+    """
+    df = df.copy()
+    for column in df.columns:
+        if getattr(df[column].dtype, 'tz', None) is not None:
+            df[column] = df[column].dt.tz_convert('UTC').dt.tz_localize(None)
+    return df
+
+
+def column_type(sqlalchemy, declared):
+    """Returns the SQLAlchemy type of a declared MySQL type such as 'VARCHAR(64)' or 'TINYINT UNSIGNED'."""
+    name, length = DECLARED_TYPE_PATTERN.match(declared).groups()
+    mysql = importlib.import_module('sqlalchemy.dialects.mysql')
+    if name == 'TINYINT UNSIGNED':
+        return sqlalchemy.SmallInteger().with_variant(mysql.TINYINT(unsigned=True), 'mysql')
+    if name == 'SMALLINT':
+        return sqlalchemy.SmallInteger()
+    if name == 'INT UNSIGNED':
+        return sqlalchemy.Integer().with_variant(mysql.INTEGER(unsigned=True), 'mysql')
+    if name == 'FLOAT':
+        return sqlalchemy.Float()
+    if name == 'DATETIME':
+        return sqlalchemy.DateTime()
+    if name == 'DATE':
+        return sqlalchemy.Date()
+    if name == 'CHAR':
+        return sqlalchemy.CHAR(int(length))
+    if name == 'VARCHAR':
+        return sqlalchemy.String(int(length))
+    raise ValueError(f"Unknown column type {declared}")
+
+
+def column_types(table_name):
+    """Returns the SQLAlchemy type of every column of a table, e.g. for the 'dtype' argument of 'to_sql'."""
+    sqlalchemy = importlib.import_module('sqlalchemy')
+    return {column: column_type(sqlalchemy, sql_type) for column, dtype, sql_type in TABLES[table_name]}
+
+
+def arrow_type(pa, dtype, sql_type):
+    """Returns the Arrow type of a declared column, as written to Parquet: categoricals are plain strings (Parquet dictionary-encodes them anyway)."""
+    if sql_type == 'DATE':
+        return pa.date32()
+    if dtype.startswith('datetime64[ns, '):
+        return pa.timestamp('ns', tz=dtype[len('datetime64[ns, '):-1])
+    if dtype.startswith('datetime64'):
+        return pa.timestamp('ns')
+    if dtype in ('object', 'category'):
+        return pa.string()
+    # Numbers have the same names in both libraries, e.g. 'int16' or 'float32'.
+    return getattr(pa, dtype)()
+
+
+def arrow_schema(table_name):
+    """Returns the Arrow schema of a table, e.g. for writing it to Parquet. Naive datetimes given for UTC columns are taken as UTC."""
+    pa = importlib.import_module('pyarrow')
+    return pa.schema([(column, arrow_type(pa, dtype, sql_type)) for column, dtype, sql_type in TABLES[table_name]])
+
+
+def sqlalchemy_table(table_name, metadata=None):
+    """
+    Returns the SQLAlchemy Table of a table, with the declared column types and a unique index on its natural key.
+
+    Parameters:
+    - table_name (str): Name of the table.
+    - metadata (MetaData): Metadata the table belongs to. A new one by default.
+
+    Returns:
+    - Table: The table, e.g. to create it with 'table.create(connection, checkfirst=True)'.
+    """
+    sqlalchemy = importlib.import_module('sqlalchemy')
+    return sqlalchemy.Table(table_name, metadata if metadata is not None else sqlalchemy.MetaData(),
+                            *[sqlalchemy.Column(column, column_type(sqlalchemy, sql_type)) for column, dtype, sql_type in TABLES[table_name]],
+                            sqlalchemy.UniqueConstraint(*NATURAL_KEYS[table_name], name=f'uq_{table_name}_natural_key'))
+
+
+def delete_duplicates(connection, table_name, key_columns, batch_size=1000):
+    """
+    Deletes the rows of a table whose natural key is stored more than once, keeping the latest row of every key:
+    the one retrieved last (RETRIEVAL_COLUMNS), ties broken by the primary key and then the other columns.
+
+    Parameters:
+    - connection (Connection): Open SQLAlchemy connection, in the transaction creating the unique index.
+    - table_name (str): Name of the table.
+    - key_columns (list): Columns forming the natural key.
+    - batch_size (int): Number of keys deleted per statement.
+
+    Returns:
+    - int: Number of rows deleted.
+    """
+    sqlalchemy = importlib.import_module('sqlalchemy')
+    table = sqlalchemy.Table(table_name, sqlalchemy.MetaData(), autoload_with=connection)
+    key = sqlalchemy.tuple_(*[table.c[column] for column in key_columns])
+
+    # Read the rows of the repeated keys, oldest first: the last row read of a key is its latest one. Tables appended
+    # with 'to_sql' have no primary key, and the database returns rows in any order, so every column is sorted on.
+    order = [RETRIEVAL_COLUMNS[table_name]] if RETRIEVAL_COLUMNS.get(table_name) in table.c else []
+    order += [column.name for column in table.primary_key.columns if column.name not in order]
+    order += [column.name for column in table.columns if column.name not in order]
+    repeated = (sqlalchemy.select(*[table.c[column] for column in key_columns])
+                .group_by(*[table.c[column] for column in key_columns])
+                .having(sqlalchemy.func.count() > 1))
+    latest = {}
+    stored = 0
+    rows = sqlalchemy.select(table).where(key.in_(repeated)).order_by(*[table.c[column] for column in order])
+    for row in connection.execute(rows).mappings():
+        latest[tuple(row[column] for column in key_columns)] = dict(row)
+        stored += 1
+    if not latest:
+        return 0
+
+    # Delete every row of these keys, then insert their latest row again. MySQL can't delete from a table read in a
+    # subquery of the same statement, so the keys are listed.
+    keys = list(latest)
+    for start in range(0, len(keys), batch_size):
+        connection.execute(table.delete().where(key.in_(keys[start:start + batch_size])))
+    connection.execute(table.insert(), list(latest.values()))
+    return stored - len(latest)
+
+
+def legacy_key_columns(connection, table_name, key_columns=None):
+    """
+    Returns the natural key columns of a table stored as TEXT, as created by the 'to_sql' appends of the first version
+    of the notebook: MySQL can't index them, and their values don't match the rows written since. Empty for other tables.
+    """
+    sqlalchemy = importlib.import_module('sqlalchemy')
+    key_columns = list(key_columns or NATURAL_KEYS[table_name])
+    types = {column['name']: column['type'] for column in sqlalchemy.inspect(connection).get_columns(table_name)}
+    return [column for column in key_columns if isinstance(types.get(column), sqlalchemy.Text)]
+
+
+def ensure_natural_key(connection, table_name, key_columns=None):
+    """
+    Creates a unique index on the natural key columns of a table, unless one already exists.
+    Rows stored more than once before the index existed are deleted first, keeping the latest row of every key.
+
+    Parameters:
+    - connection (Connection): Open SQLAlchemy connection. The duplicates are deleted and the index created in its transaction.
+    - table_name (str): Name of the table.
+    - key_columns (list): Columns forming the natural key. Defaults to the entry in NATURAL_KEYS.
+
+    Returns:
+    - int: Number of duplicated rows deleted.
+
+    Raises:
+    - LegacyTableError: The table was created by the first version of the notebook, see 'migrate_legacy_table'.
+    """
+    sqlalchemy = importlib.import_module('sqlalchemy')
+    key_columns = list(key_columns or NATURAL_KEYS[table_name])
+
+    # Look for an existing unique index or constraint on exactly these columns.
+    inspector = sqlalchemy.inspect(connection)
+    unique_keys = [index['column_names'] for index in inspector.get_indexes(table_name) if index['unique']]
+    unique_keys += [constraint['column_names'] for constraint in inspector.get_unique_constraints(table_name)]
+    if key_columns in unique_keys:
+        return 0
+
+    # Refuse the tables of the first notebook: indexing them would fail on MySQL (TEXT columns), and their keys would
+    # never match the new rows, so every row would be stored again.
+    legacy_columns = legacy_key_columns(connection, table_name, key_columns)
+    if legacy_columns:
+        raise LegacyTableError(
+            f"Table '{table_name}' was created by the first version of the notebook: its key columns {legacy_columns} are TEXT "
+            f"and its times aren't stored in UTC. Migrate it once with gans_schema.migrate_legacy_table(engine, '{table_name}'"
+            f"{', airport_timezones=...' if table_name == 'cities_arrivals' else ''}) before writing to it.")
+
+    # Create the index. Rows already duplicated in the table have to be removed first, otherwise the database refuses it.
+    deleted = delete_duplicates(connection, table_name, key_columns)
+    quote = connection.dialect.identifier_preparer.quote
+    connection.execute(sqlalchemy.text(
+        f"CREATE UNIQUE INDEX {quote('uq_' + table_name + '_natural_key')} ON {quote(table_name)} "
+        f"({', '.join(quote(column) for column in key_columns)})"))
+    return deleted
+
+
+def convert_legacy_rows(df, table_name, airport_timezones=None):
+    """
+    Converts the rows of a table written by the first version of the notebook to the declared schema of the table.
+
+    Parameters:
+    - df (DataFrame): Rows read from the legacy table.
+    - table_name (str): Name of the table.
+    - airport_timezones (dict): Time zone of every arrival airport, by ICAO code, e.g. {'EDDB': 'Europe/Berlin'}.
+      Required for 'cities_arrivals', whose arrival times were stored in the local time of the airport.
+
+    Returns:
+    - DataFrame: The rows in the declared schema, keeping only the latest row of every natural key.
+    """
+    pd = importlib.import_module('pandas')
+    df = df.copy()
+    for column, (time_format, tz) in LEGACY_TIME_FORMATS.get(table_name, {}).items():
+        # DST changes make some local times ambiguous or missing: take the standard time, or the next valid time.
+        df[column] = (pd.to_datetime(df[column], format=time_format)
+                      .dt.tz_localize(tz, ambiguous=False, nonexistent='shift_forward').dt.tz_convert('UTC'))
+    if table_name == 'cities_arrivals':
+        airport_timezones = airport_timezones or {}
+        unknown = sorted(set(df['arrival_airport_icao'].dropna()) - set(airport_timezones))
+        if unknown:
+            raise ValueError(f"No time zone in 'airport_timezones' for the arrival airports {', '.join(unknown)}")
+        local_times = pd.to_datetime(df['arrival_time'])
+        arrival_times = pd.Series(pd.NaT, index=df.index, dtype='datetime64[ns, UTC]')
+        for icao, rows in df.groupby('arrival_airport_icao').groups.items():
+            arrival_times[rows] = (local_times[rows].dt.tz_localize(airport_timezones[icao], ambiguous=False, nonexistent='shift_forward')
+                                   .dt.tz_convert('UTC'))
+        df['arrival_time'] = arrival_times
+    df = enforce(df, table_name)
+
+    # Keep the latest row of every key, as 'delete_duplicates' does.
+    retrieval_column = RETRIEVAL_COLUMNS.get(table_name)
+    if retrieval_column:
+        df = df.sort_values(retrieval_column, kind='stable')
+    return df.drop_duplicates(subset=NATURAL_KEYS[table_name], keep='last')
+
+
+def migrate_legacy_table(engine, table_name, airport_timezones=None, batch_size=1000):
+    """
+    Converts a table created by the first version of the notebook to the declared schema: the table is renamed
+    '<table>_legacy' and kept as a backup, and its rows are converted ('convert_legacy_rows') and written to the table
+    created again with the declared column types and unique index. Does nothing for a table that isn't legacy.
+
+    Parameters:
+    - engine (Engine): Engine of the database.
+    - table_name (str): Name of the table.
+    - airport_timezones (dict): Time zone of every arrival airport, by ICAO code. Required for 'cities_arrivals'.
+    - batch_size (int): Number of rows written per statement.
+
+    Returns:
+    - dict: Number of rows 'read' from the legacy table and 'written' to the new one (duplicates are dropped).
+    """
+    pd = importlib.import_module('pandas')
+    sqlalchemy = importlib.import_module('sqlalchemy')
+    legacy_name = table_name + '_legacy'
+    with engine.connect() as connection:
+        inspector = sqlalchemy.inspect(connection)
+        if not inspector.has_table(table_name) or not legacy_key_columns(connection, table_name):
+            return {'read': 0, 'written': 0}
+        if inspector.has_table(legacy_name):
+            raise LegacyTableError(f"Table '{legacy_name}' already exists: drop or rename it before migrating '{table_name}' again")
+        legacy = pd.read_sql_table(table_name, connection)
+
+    # Convert every row before changing the database, so that rows which can't be converted leave it untouched.
+    df = to_database(convert_legacy_rows(legacy, table_name, airport_timezones))
+    # NaN and NaT become NULL, timestamps plain datetimes, or dates in DATE columns.
+    dates = [column for column, dtype, sql_type in TABLES[table_name] if sql_type == 'DATE']
+    records = [{column: (value.date() if column in dates else value.to_pydatetime()) if isinstance(value, pd.Timestamp) else value
+                for column, value in row.items()}
+               for row in df.astype(object).where(df.notna(), None).to_dict('records')]
+
+    quote = engine.dialect.identifier_preparer.quote
+    with engine.begin() as connection:
+        connection.execute(sqlalchemy.text(f"ALTER TABLE {quote(table_name)} RENAME TO {quote(legacy_name)}"))
+    with engine.begin() as connection:
+        table = sqlalchemy_table(table_name)
+        table.create(connection)
+        for start in range(0, len(records), batch_size):
+            connection.execute(table.insert(), records[start:start + batch_size])
+    return {'read': len(legacy), 'written': len(records)}